@@ -0,0 +1,116 @@
+from sqlalchemy import func, select, union_all
+from models import db, StockBalance, MarathonSummary, Station, Equipment
+from balances import FLOWS, NO_ID
+
+
+def _station(station_id):
+    return None if station_id == NO_ID else station_id
+
+
+def marathon_balances(marathon_id):
+    """Subquery of a marathon's StockBalance rows plus its frozen close-out summary rows.
+
+    A key can appear in both when records were added after the close-out, so
+    readers sum the flows per key.
+    """
+    def rows(model):
+        return select(model.station_id, model.equipment_id, *[getattr(model, flow) for flow in FLOWS]
+                      ).where(model.marathon_id == marathon_id)
+    return union_all(rows(StockBalance), rows(MarathonSummary)).subquery()
+
+
+def station_equipment_totals(marathon_id):
+    """Issued/returned quantities per (station_id, equipment_id) for a marathon.
+
+    Returns a dict {(station_id, equipment_id): {'issued': int, 'returned': int}}
+    summed from the balance rows of the marathon (see marathon_balances).
+    """
+    b = marathon_balances(marathon_id)
+    rows = db.session.query(
+        b.c.station_id, b.c.equipment_id, func.sum(b.c.issued).label('issued'), func.sum(b.c.returned).label('returned')
+    ).group_by(b.c.station_id, b.c.equipment_id).all()
+    return {(_station(r.station_id), r.equipment_id): {'issued': int(r.issued), 'returned': int(r.returned)} for r in rows}
+
+
+def build_report_views(totals, equipments, stations):
+    """Split station/equipment totals into the two views shown on the report page.
+
+    `equipments` and `stations` are the name-ordered lists used by the page, so the
+    output keeps the same ordering as before.
+    Returns (equipment_summary, station_details).
+    """
+    by_equipment = {}
+    by_station = {}
+    for (station_id, equipment_id), entry in totals.items():
+        eq_totals = by_equipment.setdefault(equipment_id, {'issued': 0, 'returned': 0})
+        eq_totals['issued'] += entry['issued']
+        eq_totals['returned'] += entry['returned']
+        if station_id is not None:
+            by_station.setdefault(station_id, {})[equipment_id] = entry['issued'] - entry['returned']
+
+    equipment_summary = []
+    for eq in equipments:
+        eq_totals = by_equipment.get(eq.id)
+        # Only include equipment with activity (issued or returned > 0)
+        if not eq_totals or (eq_totals['issued'] <= 0 and eq_totals['returned'] <= 0):
+            continue
+        equipment_summary.append({
+            'equipment': eq.name,
+            'issued': eq_totals['issued'],
+            'returned': eq_totals['returned'],
+            'remaining': eq_totals['issued'] - eq_totals['returned']
+        })
+
+    station_details = []
+    for st in stations:
+        diffs = by_station.get(st.id)
+        if not diffs:
+            continue
+        items = [{'equipment': eq.name, 'missing': diffs[eq.id]} for eq in equipments if diffs.get(eq.id, 0) > 0]
+        if items: station_details.append({'station': st.name, 'items': items})
+    return equipment_summary, station_details
+
+
+def empty_flow_totals():
+    return dict.fromkeys(FLOWS, 0)
+
+
+def reconciliation_totals(marathon_id):
+    """Sum all four equipment flows per equipment_id for a marathon in a single round trip.
+
+    Returns a dict {equipment_id: {'store_issued', 'issued', 'returned', 'store_returned'}}.
+    """
+    b = marathon_balances(marathon_id)
+    rows = db.session.query(
+        b.c.equipment_id, *[func.sum(b.c[flow]).label(flow) for flow in FLOWS]
+    ).group_by(b.c.equipment_id).all()
+    return {r.equipment_id: {flow: int(getattr(r, flow) or 0) for flow in FLOWS} for r in rows}
+
+
+def unreturned_items(marathon_id, station_id=None):
+    """Outstanding (issued - returned) quantities of a marathon with names joined in.
+
+    Returns [{'station_id', 'station', 'equipment_id', 'equipment', 'missing'}] ordered
+    by station and equipment id; station fields are None for records without a station.
+    """
+    b = marathon_balances(marathon_id)
+    missing = (func.sum(b.c.issued) - func.sum(b.c.returned)).label('missing')
+    query = db.session.query(
+        b.c.station_id, b.c.equipment_id, missing
+    )
+    if station_id:
+        query = query.filter(b.c.station_id == station_id)
+    totals = query.group_by(b.c.station_id, b.c.equipment_id).having(missing > 0).subquery()
+    query = db.session.query(
+        totals.c.station_id, Station.name.label('station'), totals.c.equipment_id,
+        Equipment.name.label('equipment'), totals.c.missing
+    ).outerjoin(Station, Station.id == totals.c.station_id
+    ).outerjoin(Equipment, Equipment.id == totals.c.equipment_id
+    ).order_by(totals.c.station_id, totals.c.equipment_id)
+    return [{
+        'station_id': _station(r.station_id),
+        'station': r.station,
+        'equipment_id': r.equipment_id,
+        'equipment': r.equipment,
+        'missing': int(r.missing),
+    } for r in query.all()]
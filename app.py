@@ -1,7 +1,31 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash
-from models import db, init_db, Station, Equipment, Person, Marathon, IssueRecord, ReturnRecord, User, StoreIssueRecord, StoreReturnRecord
-from datetime import datetime
+import json
+import time
+import threading
+import click
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, g, send_from_directory, Response, stream_with_context
+from sqlalchemy.orm import joinedload
+from models import db, Station, Equipment, Person, Marathon, IssueRecord, ReturnRecord, User, StoreIssueRecord, StoreReturnRecord, MarathonArchive
+from aggregation import station_equipment_totals, build_report_views, reconciliation_totals, empty_flow_totals, unreturned_items
+from balances import rebuild_balances, ledger_version
+from indexes import check_indexes
+from refcache import reference_list, reference_version, REFERENCE_LISTS
+from history import transaction_history, STATION_STREAMS, STORE_STREAMS, ALL_STREAMS
+from exports import export_rows, stream_csv, stream_xlsx, parse_time_bound
+from records import RECORD_TYPES, resolve_names, canonical_name, item_rows, insert_records, ingest_batch, prune_idempotency_keys
+from sync import reference_delta
+from dashboard import dashboard_section, SECTIONS as DASHBOARD_SECTIONS, DASHBOARD_PAGE_SIZE
+from migrations import migrate
+from sqlitemode import configure_sqlite, serialized_writes
+from querystats import install_query_stats
+from metrics import install_metrics, render_metrics
+from profiling import install_profiling, profile_token, recent_profiles, profiles_dir, PROFILE_PARAM
+from search import search_names, name_taken, SEARCH_MODELS, SEARCH_LIMIT, SEARCH_MAX_LIMIT
+from events import event_stream, latest_event_id, read_at_cursor, prune_events
+from importer import read_items, import_records, import_references, IMPORT_BATCH_SIZE
+from closeout import close_marathon, reopen_marathon
 from dotenv import load_dotenv
 from functools import wraps
 load_dotenv()
@@ -11,10 +35,71 @@ if database_url.startswith("postgres://"):
     database_url = database_url.replace("postgres://","postgresql://",1)
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the database backend, tunable with DB_* environment variables"""
+    if url.startswith('sqlite'):
+        return {}
+    options = {
+        # One connection per request thread; gunicorn.conf.py exports WEB_THREADS
+        'pool_size': int(os.getenv("DB_POOL_SIZE", os.getenv("WEB_THREADS", "5"))),
+        'max_overflow': int(os.getenv("DB_MAX_OVERFLOW", "2")),
+        'pool_timeout': float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        # Hosted Postgres drops idle connections; replace them before they go stale
+        'pool_recycle': int(os.getenv("DB_POOL_RECYCLE", "300")),
+        'pool_pre_ping': os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+    if statement_timeout and url.startswith('postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    return options
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "dev-secret-key-change-in-production")
+# Seconds a worker may reuse a user's role and marathon assignments across requests (0 disables).
+# Changes made on another worker become visible after at most this long.
+app.config['USER_CACHE_TTL'] = float(os.getenv("USER_CACHE_TTL", "0"))
+# Largest number of records accepted by one /api/records/batch request
+app.config['BATCH_MAX_RECORDS'] = int(os.getenv("BATCH_MAX_RECORDS", "1000"))
+# SQLite tuning for serving a race from a single box: WAL, relaxed fsync and mmap reads
+app.config['SQLITE_PRODUCTION'] = os.getenv("SQLITE_PRODUCTION", "0") == "1"
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Serialize record writes within each worker process (SQLite only)
+app.config['SQLITE_WRITE_QUEUE'] = os.getenv("SQLITE_WRITE_QUEUE", "0") == "1"
+# Per-request SQL instrumentation: Server-Timing header and slow-request log thresholds
+app.config['SERVER_TIMING'] = os.getenv("SERVER_TIMING", "1") == "1"
+app.config['QUERY_LOG_COUNT'] = int(os.getenv("QUERY_LOG_COUNT", "50"))
+app.config['QUERY_LOG_MS'] = float(os.getenv("QUERY_LOG_MS", "500"))
+# Live report updates over /api/marathons/<id>/events: SQLite poll interval, keepalive comments,
+# stream lifetime before the browser reconnects, and open streams per worker (each holds a thread)
+app.config['EVENTS_POLL_SECONDS'] = float(os.getenv("EVENTS_POLL_SECONDS", "2"))
+app.config['EVENTS_KEEPALIVE_SECONDS'] = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))
+app.config['EVENTS_STREAM_SECONDS'] = float(os.getenv("EVENTS_STREAM_SECONDS", "300"))
+app.config['EVENTS_MAX_STREAMS'] = int(os.getenv("EVENTS_MAX_STREAMS", str(max(int(os.getenv("WEB_THREADS", "4")) // 2, 1))))
+_event_stream_slots = threading.BoundedSemaphore(app.config['EVENTS_MAX_STREAMS'])
+# The schema is created and upgraded by `flask migrate` at deploy time, not on import
 db.init_app(app)
 with app.app_context():
-    init_db()
+    if database_url.startswith('sqlite'):
+        configure_sqlite(db.engine, app.config['SQLITE_BUSY_TIMEOUT_MS'],
+                         app.config['SQLITE_PRODUCTION'], app.config['SQLITE_MMAP_SIZE'])
+    install_query_stats(app, db.engine)
+# Bearer token required by /metrics when set; leave empty for an open endpoint behind a firewall
+app.config['METRICS_TOKEN'] = os.getenv("METRICS_TOKEN", "")
+install_metrics(app, lambda: pool_stats())
+# Admin request profiling via a signed ?_profile= token (PROFILING=0 removes the hooks)
+if os.getenv("PROFILING", "1") == "1":
+    install_profiling(app, lambda: (get_user_access() or (None,))[0] == 'admin')
+
+def pool_stats():
+    """Connection pool counters of this worker process"""
+    pool = db.engine.pool
+    stats = {'pid': os.getpid(), 'pool': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
 
 # Login required decorator
 def login_required(f):
@@ -33,8 +118,8 @@ def admin_required(f):
         if not session.get('user_id'):
             flash('Vui lòng đăng nhập để truy cập trang này.', 'warning')
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
-        if not user or user.role != 'admin':
+        access = get_user_access()
+        if not access or access[0] != 'admin':
             flash('Bạn không có quyền truy cập trang này.', 'danger')
             return redirect(url_for('index'))
         return f(*args, **kwargs)
@@ -47,17 +132,63 @@ def admin_or_storekeeper_required(f):
         if not session.get('user_id'):
             flash('Vui lòng đăng nhập để truy cập trang này.', 'warning')
             return redirect(url_for('login'))
-        user = User.query.get(session['user_id'])
-        if not user or user.role not in ['admin', 'storekeeper']:
+        access = get_user_access()
+        if not access or access[0] not in ['admin', 'storekeeper']:
             flash('Bạn không có quyền truy cập trang này.', 'danger')
             return redirect(url_for('index'))
         return f(*args, **kwargs)
     return decorated_function
 
+# Read-only view of the logged-in user; views that change the account load the User row
+CurrentUser = namedtuple('CurrentUser', 'id username role marathon_ids')
+
+_user_access_cache = {}
+_user_access_lock = threading.Lock()
+
 def get_current_user():
-    if session.get('user_id'):
-        return User.query.get(session['user_id'])
-    return None
+    """Logged-in user as a CurrentUser, loaded once per request with the assigned marathon ids.
+
+    Served from a per-worker cache for USER_CACHE_TTL seconds when enabled.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    if 'current_user' in g:
+        return g.current_user
+    ttl = app.config['USER_CACHE_TTL']
+    if ttl > 0:
+        with _user_access_lock:
+            cached = _user_access_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            g.current_user = cached[1]
+            return g.current_user
+    user = User.query.options(joinedload(User.assigned_marathons)).filter_by(id=user_id).first()
+    g.current_user = user and CurrentUser(user.id, user.username, user.role,
+                                          frozenset(m.id for m in user.assigned_marathons))
+    if ttl > 0 and g.current_user:
+        with _user_access_lock:
+            _user_access_cache[user_id] = (time.monotonic() + ttl, g.current_user)
+    return g.current_user
+
+def get_user_access():
+    """(role, assigned marathon ids) of the logged-in user, or None if the user is gone"""
+    user = get_current_user()
+    return (user.role, user.marathon_ids) if user else None
+
+def invalidate_user_access(user_id=None):
+    """Drop cached role/assignments for one user, or for everyone when user_id is None"""
+    with _user_access_lock:
+        if user_id is None:
+            _user_access_cache.clear()
+        else:
+            _user_access_cache.pop(user_id, None)
+
+def form_items(equipment_ids, quantities):
+    """Form rows as (equipment_id, quantity) pairs, flashing a warning for rows with an invalid equipment"""
+    items, invalid = item_rows(equipment_ids, quantities)
+    if invalid:
+        flash(f'Đã bỏ qua {invalid} dòng có thiết bị không hợp lệ.', 'warning')
+    return items
 
 def get_user_marathons(user):
     """Get marathons accessible to the user based on their role"""
@@ -65,10 +196,10 @@ def get_user_marathons(user):
         return []
     if user.role in ['admin', 'storekeeper']:
         # Admins and storekeepers can see all marathons
-        return Marathon.query.order_by(Marathon.name).all()
+        return reference_list('marathons')
     else:
         # Regular users can only see assigned marathons
-        return user.assigned_marathons
+        return [m for m in reference_list('marathons') if m.id in user.marathon_ids]
 
 @app.route('/')
 @login_required
@@ -101,7 +232,7 @@ def logout():
 @app.route('/change_password', methods=['GET', 'POST'])
 @login_required
 def change_password():
-    user = get_current_user()
+    user = db.session.get(User, get_current_user().id)
     if request.method == 'POST':
         current_password = request.form.get('current_password')
         new_password = request.form.get('new_password')
@@ -128,21 +259,18 @@ def change_password():
 
 @app.route('/issue', methods=['GET','POST'])
 @login_required
+@serialized_writes
 def issue():
     user = get_current_user()
     marathons = get_user_marathons(user)
-    stations = Station.query.order_by(Station.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
-    persons = Person.query.order_by(Person.name).all()
+    stations = reference_list('stations')
+    equipments = reference_list('equipments')
+    persons = reference_list('persons')
     if request.method=='POST':
         marathon_id = request.form.get('marathon') or None
         new_marathon = request.form.get('new_marathon')
-        if new_marathon:
-            m = Marathon(name=new_marathon); db.session.add(m); db.session.commit(); marathon_id = m.id
         station_id = request.form.get('station') or None
         new_station = request.form.get('new_station')
-        if new_station:
-            s = Station(name=new_station); db.session.add(s); db.session.commit(); station_id = s.id
         
         # Only admin can select/enter a different person, others use their username
         if user.role == 'admin':
@@ -150,30 +278,24 @@ def issue():
         else:
             person_name = user.username
         
-        person = Person.query.filter_by(name=person_name).first()
-        if not person:
-            person = Person(name=person_name); db.session.add(person); db.session.commit()
         equipment_ids = request.form.getlist('equipment[]')
         quantities = request.form.getlist('quantity[]')
         new_equipments = request.form.getlist('new_equipment[]')
         
+        # Resolve all typed names with one query per entity type; missing ones are created
+        if new_marathon and not new_marathon.isspace():
+            marathon_id = resolve_names(Marathon, [new_marathon])[new_marathon.strip()]
+        if new_station and not new_station.isspace():
+            station_id = resolve_names(Station, [new_station])[new_station.strip()]
+        person_name = canonical_name(Person, person_name)
+        # Equipment names are matched case-insensitively against existing equipment
+        new_equipment_ids = resolve_names(Equipment, new_equipments)
+        
         # Build final equipment IDs list - use new_equipment[] if it has value, otherwise use equipment[]
         final_equipment_ids = []
         for idx in range(len(quantities)):
-            # Check if new_equipment has a value for this row
             if idx < len(new_equipments) and new_equipments[idx] and not new_equipments[idx].isspace():
-                new_eq_name = new_equipments[idx].strip()
-                # Check if equipment with this name already exists (case-insensitive)
-                existing_eq = Equipment.query.filter(Equipment.name.ilike(new_eq_name)).first()
-                if existing_eq:
-                    # Use existing equipment instead of creating a new one
-                    final_equipment_ids.append(str(existing_eq.id))
-                else:
-                    # Create new equipment and use its ID
-                    eq = Equipment(name=new_eq_name)
-                    db.session.add(eq)
-                    db.session.commit()
-                    final_equipment_ids.append(str(eq.id))
+                final_equipment_ids.append(new_equipment_ids[new_equipments[idx].strip()])
             elif idx < len(equipment_ids) and equipment_ids[idx]:
                 # Use the selected equipment ID from dropdown
                 final_equipment_ids.append(equipment_ids[idx])
@@ -181,53 +303,37 @@ def issue():
                 # No equipment selected for this row
                 final_equipment_ids.append(None)
         
-        # Save records
-        for eq_id, qty in zip(final_equipment_ids, quantities):
-            try: q=int(qty)
-            except: q=0
-            if q<=0 or not eq_id: continue
-            r = IssueRecord(marathon_id=marathon_id, station_id=station_id, equipment_id=eq_id, 
-                          person_name=person.name, quantity=q, timestamp=datetime.utcnow(),
-                          created_by=user.username)
-            db.session.add(r)
+        # Save all records and any new names in a single transaction
+        insert_records(IssueRecord, form_items(final_equipment_ids, quantities), user.username,
+                       marathon_id=marathon_id, station_id=station_id, person_name=person_name)
         db.session.commit()
         return redirect(url_for('issue'))
     return render_template('issue.html', marathons=marathons, stations=stations, equipments=equipments, persons=persons, user=user)
 
 @app.route('/return', methods=['GET','POST'])
 @login_required
+@serialized_writes
 def return_equipment():
     user = get_current_user()
     marathons = get_user_marathons(user)
-    stations = Station.query.order_by(Station.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
-    persons = Person.query.order_by(Person.name).all()
+    stations = reference_list('stations')
+    equipments = reference_list('equipments')
+    persons = reference_list('persons')
     marathon_id = request.args.get('marathon') or None
     selected_station_id = request.args.get('station') or None
     unreturned = []
     if marathon_id:
-        from sqlalchemy import func
-        issued_q = db.session.query(IssueRecord.station_id, IssueRecord.equipment_id, func.sum(IssueRecord.quantity).label('issued')).filter(IssueRecord.marathon_id==marathon_id).group_by(IssueRecord.station_id, IssueRecord.equipment_id).subquery()
-        returned_q = db.session.query(ReturnRecord.station_id, ReturnRecord.equipment_id, func.sum(ReturnRecord.quantity).label('returned')).filter(ReturnRecord.marathon_id==marathon_id).group_by(ReturnRecord.station_id, ReturnRecord.equipment_id).subquery()
-        base_query = db.session.query(issued_q.c.station_id, issued_q.c.equipment_id, issued_q.c.issued, returned_q.c.returned).outerjoin(returned_q, (issued_q.c.station_id==returned_q.c.station_id)&(issued_q.c.equipment_id==returned_q.c.equipment_id))
-        if selected_station_id:
-            base_query = base_query.filter(issued_q.c.station_id == selected_station_id)
-        rows = base_query.all()
-        for r in rows:
-            returned = r.returned or 0
-            if r.issued - returned > 0:
-                st = Station.query.get(r.station_id) if r.station_id else None
-                eq = Equipment.query.get(r.equipment_id)
-                unreturned.append({'station_id': r.station_id, 'station': st.name if st else '—', 'equipment_id': r.equipment_id, 'equipment': eq.name if eq else '—', 'missing': int(r.issued-returned)})
+        unreturned = [dict(it, station=it['station'] or '—', equipment=it['equipment'] or '—')
+                      for it in unreturned_items(marathon_id, selected_station_id)]
     if request.method=='POST':
         marathon_id = request.form.get('marathon') or None
         new_marathon = request.form.get('new_marathon')
-        if new_marathon:
-            m = Marathon(name=new_marathon); db.session.add(m); db.session.commit(); marathon_id = m.id
+        if new_marathon and not new_marathon.isspace():
+            marathon_id = resolve_names(Marathon, [new_marathon])[new_marathon.strip()]
         station_id = request.form.get('station') or None
         new_station = request.form.get('new_station')
-        if new_station:
-            s = Station(name=new_station); db.session.add(s); db.session.commit(); station_id = s.id
+        if new_station and not new_station.isspace():
+            station_id = resolve_names(Station, [new_station])[new_station.strip()]
         
         # Only admin can select/enter a different person, others use their username
         if user.role == 'admin':
@@ -235,19 +341,11 @@ def return_equipment():
         else:
             person_name = user.username
         
-        person = Person.query.filter_by(name=person_name).first()
-        if not person:
-            person = Person(name=person_name); db.session.add(person); db.session.commit()
+        person_name = canonical_name(Person, person_name)
         equipment_ids = request.form.getlist('equipment[]')
         quantities = request.form.getlist('quantity[]')
-        for eq_id, qty in zip(equipment_ids, quantities):
-            try: q=int(qty)
-            except: q=0
-            if q<=0 or not eq_id: continue
-            r = ReturnRecord(marathon_id=marathon_id, station_id=station_id, equipment_id=eq_id, 
-                           person_name=person.name, quantity=q, timestamp=datetime.utcnow(),
-                           created_by=user.username)
-            db.session.add(r)
+        insert_records(ReturnRecord, form_items(equipment_ids, quantities), user.username,
+                       marathon_id=marathon_id, station_id=station_id, person_name=person_name)
         db.session.commit()
         return redirect(url_for('return_equipment', marathon=marathon_id))
     return render_template('return.html', marathons=marathons, stations=stations, equipments=equipments, 
@@ -259,83 +357,52 @@ def return_equipment():
 def report():
     user = get_current_user()
     marathon_id = request.args.get('marathon') or None
-    marathons = Marathon.query.order_by(Marathon.name).all()
+    marathons = reference_list('marathons')
     equipment_summary = []; station_details = []; transactions = []
-    from sqlalchemy import func
-    equipments = Equipment.query.order_by(Equipment.name).all()
-    stations = Station.query.order_by(Station.name).all()
+    equipments = reference_list('equipments')
+    stations = reference_list('stations')
+    live = None; closeout = None
     if marathon_id:
-        for eq in equipments:
-            issued = db.session.query(func.sum(IssueRecord.quantity)).filter(IssueRecord.equipment_id==eq.id, IssueRecord.marathon_id==marathon_id).scalar() or 0
-            returned = db.session.query(func.sum(ReturnRecord.quantity)).filter(ReturnRecord.equipment_id==eq.id, ReturnRecord.marathon_id==marathon_id).scalar() or 0
-            diff = issued - returned
-            # Only include equipment with activity (issued or returned > 0)
-            if issued > 0 or returned > 0:
-                equipment_summary.append({
-                    'equipment': eq.name,
-                    'issued': int(issued), 
-                    'returned': int(returned), 
-                    'remaining': int(diff)
-                })
-        for st in stations:
-            items = []
-            for eq in equipments:
-                issued = db.session.query(func.sum(IssueRecord.quantity)).filter(IssueRecord.equipment_id==eq.id, IssueRecord.marathon_id==marathon_id, IssueRecord.station_id==st.id).scalar() or 0
-                returned = db.session.query(func.sum(ReturnRecord.quantity)).filter(ReturnRecord.equipment_id==eq.id, ReturnRecord.marathon_id==marathon_id, ReturnRecord.station_id==st.id).scalar() or 0
-                diff = issued - returned
-                if diff>0: items.append({'equipment': eq.name, 'missing': int(diff)})
-            if items: station_details.append({'station': st.name, 'items': items})
-        # Get transaction history (only issue and return records)
-        issue_records = IssueRecord.query.filter_by(marathon_id=marathon_id).all()
-        return_records = ReturnRecord.query.filter_by(marathon_id=marathon_id).all()
-        
-        for rec in issue_records:
-            station = Station.query.get(rec.station_id) if rec.station_id else None
-            equipment = Equipment.query.get(rec.equipment_id)
-            transactions.append({
-                'type': 'issue',
-                'timestamp': rec.timestamp,
-                'station': station.name if station else None,
-                'equipment': equipment.name if equipment else None,
-                'quantity': rec.quantity,
-                'person': rec.person_name,
-                'created_by': rec.created_by
-            })
-        
-        for rec in return_records:
-            station = Station.query.get(rec.station_id) if rec.station_id else None
-            equipment = Equipment.query.get(rec.equipment_id)
-            transactions.append({
-                'type': 'return',
-                'timestamp': rec.timestamp,
-                'station': station.name if station else None,
-                'equipment': equipment.name if equipment else None,
-                'quantity': rec.quantity,
-                'person': rec.person_name,
-                'created_by': rec.created_by
-            })
-        
-        # Sort transactions by timestamp descending (newest first)
-        transactions.sort(key=lambda x: x['timestamp'] if x['timestamp'] else datetime.min, reverse=True)
-    return render_template('report.html', marathons=marathons, equipment_summary=equipment_summary, station_details=station_details, selected_marathon=marathon_id, transactions=transactions, user=user)
+        # Aggregate per (station, equipment) once, then split into both views in memory
+        if marathon_id.isdigit():
+            totals, cursor = read_at_cursor(int(marathon_id), lambda: station_equipment_totals(marathon_id))
+            closeout = db.session.get(MarathonArchive, int(marathon_id))
+        else:
+            totals, cursor = station_equipment_totals(marathon_id), None
+        equipment_summary, station_details = build_report_views(totals, equipments, stations)
+        # Get transaction history (only issue and return records), newest first
+        transactions = transaction_history(STATION_STREAMS, marathon_id=marathon_id)
+        # Totals by name and the event cursor they reflect, for live updates in the page
+        equipment_names = {e.id: e.name for e in equipments}
+        station_names = {s.id: s.name for s in stations}
+        live = {'marathon': marathon_id, 'cursor': cursor, 'totals': [
+            {'station': station_names.get(station_id), 'equipment': equipment_names.get(equipment_id), **entry}
+            for (station_id, equipment_id), entry in totals.items()]}
+    return render_template('report.html', marathons=marathons, equipment_summary=equipment_summary, station_details=station_details, selected_marathon=marathon_id, transactions=transactions, live=live, closeout=closeout, user=user)
 
 @app.route('/reconciliation_report', methods=['GET'])
 @admin_or_storekeeper_required
 def reconciliation_report():
     user = get_current_user()
     marathon_id = request.args.get('marathon') or None
-    marathons = Marathon.query.order_by(Marathon.name).all()
+    marathons = reference_list('marathons')
     equipment_summary = []; store_transactions = []
-    from sqlalchemy import func
-    equipments = Equipment.query.order_by(Equipment.name).all()
+    equipments = reference_list('equipments')
+    live = None; closeout = None
     
     if marathon_id:
         # Show statistics and records for selected marathon
+        if marathon_id.isdigit():
+            totals, cursor = read_at_cursor(int(marathon_id), lambda: reconciliation_totals(marathon_id))
+            closeout = db.session.get(MarathonArchive, int(marathon_id))
+        else:
+            totals, cursor = reconciliation_totals(marathon_id), None
         for eq in equipments:
-            store_issued = db.session.query(func.sum(StoreIssueRecord.quantity)).filter(StoreIssueRecord.equipment_id==eq.id, StoreIssueRecord.marathon_id==marathon_id).scalar() or 0
-            issued = db.session.query(func.sum(IssueRecord.quantity)).filter(IssueRecord.equipment_id==eq.id, IssueRecord.marathon_id==marathon_id).scalar() or 0
-            returned = db.session.query(func.sum(ReturnRecord.quantity)).filter(ReturnRecord.equipment_id==eq.id, ReturnRecord.marathon_id==marathon_id).scalar() or 0
-            store_returned = db.session.query(func.sum(StoreReturnRecord.quantity)).filter(StoreReturnRecord.equipment_id==eq.id, StoreReturnRecord.marathon_id==marathon_id).scalar() or 0
+            flows = totals.get(eq.id) or empty_flow_totals()
+            store_issued = flows['store_issued']
+            issued = flows['issued']
+            returned = flows['returned']
+            store_returned = flows['store_returned']
             
             # Calculate differences
             store_vs_issued = store_issued - issued  # Should be 0 if balanced
@@ -343,118 +410,83 @@ def reconciliation_report():
             
             equipment_summary.append({
                 'equipment': eq.name,
-                'store_issued': int(store_issued),
-                'issued': int(issued), 
-                'store_vs_issued_diff': int(store_vs_issued),
-                'returned': int(returned), 
-                'store_returned': int(store_returned),
-                'returned_vs_store_diff': int(returned_vs_store)
+                'store_issued': store_issued,
+                'issued': issued, 
+                'store_vs_issued_diff': store_vs_issued,
+                'returned': returned, 
+                'store_returned': store_returned,
+                'returned_vs_store_diff': returned_vs_store
             })
         
         # Get store transaction history for selected marathon
-        store_issue_records = StoreIssueRecord.query.filter_by(marathon_id=marathon_id).order_by(StoreIssueRecord.timestamp.desc()).all()
-        store_return_records = StoreReturnRecord.query.filter_by(marathon_id=marathon_id).order_by(StoreReturnRecord.timestamp.desc()).all()
-        
-        for rec in store_issue_records:
-            equipment = Equipment.query.get(rec.equipment_id)
-            marathon = Marathon.query.get(rec.marathon_id) if rec.marathon_id else None
-            store_transactions.append({
-                'type': 'store_issue',
-                'timestamp': rec.timestamp,
-                'marathon': marathon.name if marathon else '-----',
-                'equipment': equipment.name if equipment else None,
-                'quantity': rec.quantity,
-                'person': rec.person_name,
-                'created_by': rec.created_by
-            })
-        
-        for rec in store_return_records:
-            equipment = Equipment.query.get(rec.equipment_id)
-            marathon = Marathon.query.get(rec.marathon_id) if rec.marathon_id else None
-            store_transactions.append({
-                'type': 'store_return',
-                'timestamp': rec.timestamp,
-                'marathon': marathon.name if marathon else '-----',
-                'equipment': equipment.name if equipment else None,
-                'quantity': rec.quantity,
-                'person': rec.person_name,
-                'created_by': rec.created_by
-            })
-        
-        # Sort transactions by timestamp descending (newest first)
-        store_transactions.sort(key=lambda x: x['timestamp'] if x['timestamp'] else datetime.min, reverse=True)
+        store_transactions = transaction_history(STORE_STREAMS, marathon_id=marathon_id)
+        marathon_name = next((m.name for m in marathons if str(m.id) == marathon_id), None)
+        live = {'marathon': marathon_id, 'name': marathon_name, 'cursor': cursor, 'totals': equipment_summary}
     else:
         # Show 100 most recent store issue/return records when no marathon is selected
-        store_issue_records = StoreIssueRecord.query.order_by(StoreIssueRecord.timestamp.desc()).limit(100).all()
-        store_return_records = StoreReturnRecord.query.order_by(StoreReturnRecord.timestamp.desc()).limit(100).all()
-        
-        for rec in store_issue_records:
-            equipment = Equipment.query.get(rec.equipment_id)
-            marathon = Marathon.query.get(rec.marathon_id) if rec.marathon_id else None
-            store_transactions.append({
-                'type': 'store_issue',
-                'timestamp': rec.timestamp,
-                'marathon': marathon.name if marathon else '-----',
-                'equipment': equipment.name if equipment else None,
-                'quantity': rec.quantity,
-                'person': rec.person_name,
-                'created_by': rec.created_by
-            })
-        
-        for rec in store_return_records:
-            equipment = Equipment.query.get(rec.equipment_id)
-            marathon = Marathon.query.get(rec.marathon_id) if rec.marathon_id else None
-            store_transactions.append({
-                'type': 'store_return',
-                'timestamp': rec.timestamp,
-                'marathon': marathon.name if marathon else '-----',
-                'equipment': equipment.name if equipment else None,
-                'quantity': rec.quantity,
-                'person': rec.person_name,
-                'created_by': rec.created_by
-            })
-        
-        # Sort transactions by timestamp descending (newest first)
-        store_transactions.sort(key=lambda x: x['timestamp'] if x['timestamp'] else datetime.min, reverse=True)
+        store_transactions = transaction_history(STORE_STREAMS, limit=100)
+    for t in store_transactions:
+        t['marathon'] = t['marathon'] or '-----'
     
     return render_template('reconciliation_report.html', marathons=marathons, equipment_summary=equipment_summary, 
-                         selected_marathon=marathon_id, store_transactions=store_transactions, user=user)
+                         selected_marathon=marathon_id, store_transactions=store_transactions, live=live, closeout=closeout, user=user)
+
+def export_response(streams, filename, **filters):
+    """Stream transaction history as CSV (default) or XLSX, filtered by ?station=&start=&end="""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'xlsx'):
+        return jsonify({'error': 'format must be csv or xlsx'}), 400
+    try:
+        filters['start'] = parse_time_bound(request.args.get('start'))
+        filters['end'] = parse_time_bound(request.args.get('end'), end=True)
+    except ValueError:
+        return jsonify({'error': 'invalid start or end'}), 400
+    filters['station_id'] = request.args.get('station') or None
+    rows = export_rows(streams, **filters)
+    if fmt == 'xlsx':
+        body, mimetype = stream_xlsx(rows), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body, mimetype = stream_csv(rows), 'text/csv; charset=utf-8'
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}.{fmt}'})
+
+@app.route('/report/export', methods=['GET'])
+@login_required
+def report_export():
+    marathon_id = request.args.get('marathon') or None
+    if not marathon_id:
+        return jsonify({'error': 'missing marathon'}), 400
+    return export_response(STATION_STREAMS, f'bao-cao-{marathon_id}', marathon_id=marathon_id)
+
+@app.route('/reconciliation_report/export', methods=['GET'])
+@admin_or_storekeeper_required
+def reconciliation_report_export():
+    """Full issue/return/store history, optionally limited to one marathon"""
+    marathon_id = request.args.get('marathon') or None
+    return export_response(ALL_STREAMS, f'doi-soat-{marathon_id or "tat-ca"}', marathon_id=marathon_id)
 
 @app.route('/store_issue', methods=['GET','POST'])
 @login_required
+@serialized_writes
 def store_issue():
     user = get_current_user()
-    marathons = Marathon.query.order_by(Marathon.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
-    persons = Person.query.order_by(Person.name).all()
+    marathons = reference_list('marathons')
+    equipments = reference_list('equipments')
+    persons = reference_list('persons')
     if request.method=='POST':
         marathon_id = request.form.get('marathon') or None
         new_marathon = request.form.get('new_marathon')
-        if new_marathon:
-            m = Marathon(name=new_marathon)
-            db.session.add(m)
-            db.session.commit()
-            marathon_id = m.id
+        if new_marathon and not new_marathon.isspace():
+            marathon_id = resolve_names(Marathon, [new_marathon])[new_marathon.strip()]
         
         person_name = request.form.get('person') or request.form.get('new_person')
         if person_name:
-            person = Person.query.filter_by(name=person_name).first()
-            if not person:
-                person = Person(name=person_name)
-                db.session.add(person)
-                db.session.commit()
+            person_name = canonical_name(Person, person_name)
         
         equipment_ids = request.form.getlist('equipment[]')
         quantities = request.form.getlist('quantity[]')
-        
-        for eq_id, qty in zip(equipment_ids, quantities):
-            try: q=int(qty)
-            except: q=0
-            if q<=0 or not eq_id: continue
-            r = StoreIssueRecord(marathon_id=marathon_id, equipment_id=eq_id, 
-                          person_name=person_name, quantity=q, timestamp=datetime.utcnow(),
-                          created_by=user.username)
-            db.session.add(r)
+        insert_records(StoreIssueRecord, form_items(equipment_ids, quantities), user.username,
+                       marathon_id=marathon_id, person_name=person_name)
         db.session.commit()
         flash('Xuất kho thành công!', 'success')
         return redirect(url_for('store_issue'))
@@ -462,42 +494,25 @@ def store_issue():
 
 @app.route('/store_return', methods=['GET','POST'])
 @login_required
+@serialized_writes
 def store_return():
     user = get_current_user()
-    marathons = Marathon.query.order_by(Marathon.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
-    persons = Person.query.order_by(Person.name).all()
+    marathons = reference_list('marathons')
+    equipments = reference_list('equipments')
+    persons = reference_list('persons')
     marathon_id = request.args.get('marathon') or None
     unreturned = []
     if marathon_id:
-        from sqlalchemy import func
-        # Calculate: store_issued - issue + return - store_returned
-        store_issued_q = db.session.query(StoreIssueRecord.equipment_id, func.sum(StoreIssueRecord.quantity).label('store_issued')).filter(StoreIssueRecord.marathon_id==marathon_id).group_by(StoreIssueRecord.equipment_id).subquery()
-        issued_q = db.session.query(IssueRecord.equipment_id, func.sum(IssueRecord.quantity).label('issued')).filter(IssueRecord.marathon_id==marathon_id).group_by(IssueRecord.equipment_id).subquery()
-        returned_q = db.session.query(ReturnRecord.equipment_id, func.sum(ReturnRecord.quantity).label('returned')).filter(ReturnRecord.marathon_id==marathon_id).group_by(ReturnRecord.equipment_id).subquery()
-        store_returned_q = db.session.query(StoreReturnRecord.equipment_id, func.sum(StoreReturnRecord.quantity).label('store_returned')).filter(StoreReturnRecord.marathon_id==marathon_id).group_by(StoreReturnRecord.equipment_id).subquery()
-        
-        base_query = db.session.query(
-            store_issued_q.c.equipment_id,
-            store_issued_q.c.store_issued,
-            issued_q.c.issued,
-            returned_q.c.returned,
-            store_returned_q.c.store_returned
-        ).outerjoin(issued_q, store_issued_q.c.equipment_id==issued_q.c.equipment_id
-        ).outerjoin(returned_q, store_issued_q.c.equipment_id==returned_q.c.equipment_id
-        ).outerjoin(store_returned_q, store_issued_q.c.equipment_id==store_returned_q.c.equipment_id)
-        
-        rows = base_query.all()
-        for r in rows:
-            store_issued = r.store_issued or 0
-            issued = r.issued or 0
-            returned = r.returned or 0
-            store_returned = r.store_returned or 0
-            # Available to return to store = returned from stations - already returned to store
-            available = returned - store_returned
+        # Available to return to store = returned from stations - already returned to store.
+        # Every equipment with any flow in this marathon is considered, not only store-issued ones.
+        totals = reconciliation_totals(marathon_id)
+        for eq in equipments:
+            flows = totals.get(eq.id)
+            if not flows:
+                continue
+            available = flows['returned'] - flows['store_returned']
             if available > 0:
-                eq = Equipment.query.get(r.equipment_id)
-                unreturned.append({'equipment_id': r.equipment_id, 'equipment': eq.name if eq else '—', 'available': int(available)})
+                unreturned.append({'equipment_id': eq.id, 'equipment': eq.name, 'available': available})
     
     if request.method=='POST':
         # Get marathon_id from form data (for non-race returns) or from query string (for race-specific returns)
@@ -509,23 +524,12 @@ def store_return():
         
         person_name = request.form.get('person') or request.form.get('new_person')
         if person_name:
-            person = Person.query.filter_by(name=person_name).first()
-            if not person:
-                person = Person(name=person_name)
-                db.session.add(person)
-                db.session.commit()
+            person_name = canonical_name(Person, person_name)
         
         equipment_ids = request.form.getlist('equipment[]')
         quantities = request.form.getlist('quantity[]')
-        
-        for eq_id, qty in zip(equipment_ids, quantities):
-            try: q=int(qty)
-            except: q=0
-            if q<=0 or not eq_id: continue
-            r = StoreReturnRecord(marathon_id=marathon_id, equipment_id=eq_id, 
-                           person_name=person_name, quantity=q, timestamp=datetime.utcnow(),
-                           created_by=user.username)
-            db.session.add(r)
+        insert_records(StoreReturnRecord, form_items(equipment_ids, quantities), user.username,
+                       marathon_id=marathon_id, person_name=person_name)
         db.session.commit()
         flash('Nhập kho thành công!', 'success')
         # Redirect back to the same page with or without marathon parameter
@@ -537,34 +541,175 @@ def store_return():
     return render_template('store_return.html', marathons=marathons, equipments=equipments, persons=persons,
                          unreturned=unreturned, selected_marathon=marathon_id, user=user)
 
+def json_name():
+    """Stripped `name` of a JSON request body, or None when missing, blank or not a string"""
+    payload = request.get_json(silent=True)
+    name = payload.get('name') if isinstance(payload, dict) else None
+    return name.strip() if isinstance(name, str) and name.strip() else None
+
 @app.route('/api/add_station', methods=['POST'])
 @login_required
 def api_add_station():
-    name = request.json.get('name')
+    name = json_name()
     if not name: return jsonify({'error':'missing name'}),400
-    s = Station(name=name); db.session.add(s); db.session.commit()
+    s = db.session.get(Station, resolve_names(Station, [name])[name]); db.session.commit()
     return jsonify({'id':s.id,'name':s.name})
 
 @app.route('/api/add_equipment', methods=['POST'])
 @login_required
 def api_add_equipment():
-    name = request.json.get('name')
+    name = json_name()
     if not name: return jsonify({'error':'missing name'}),400
-    e = Equipment(name=name); db.session.add(e); db.session.commit()
+    e = db.session.get(Equipment, resolve_names(Equipment, [name])[name]); db.session.commit()
     return jsonify({'id':e.id,'name':e.name})
 
 @app.route('/api/add_marathon', methods=['POST'])
 @login_required
 def api_add_marathon():
-    name = request.json.get('name')
+    name = json_name()
     if not name: return jsonify({'error':'missing name'}),400
-    m = Marathon(name=name); db.session.add(m); db.session.commit()
+    m = db.session.get(Marathon, resolve_names(Marathon, [name])[name]); db.session.commit()
     return jsonify({'id':m.id,'name':m.name})
 
+@app.route('/api/records/batch', methods=['POST'])
+@login_required
+@serialized_writes
+def api_records_batch():
+    """Insert many issue/return/store records from one JSON payload in a single transaction.
+
+    Body: {"records": [{"type", "equipment_id", "quantity", "marathon_id", "station_id",
+    "person_name", "timestamp", "key"}, ...]}. Records whose "key" was already
+    ingested are skipped, so retried uploads never double-count.
+    """
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('records') if isinstance(payload, dict) else None
+    if not isinstance(items, list):
+        return jsonify({'error': 'missing records'}), 400
+    if len(items) > app.config['BATCH_MAX_RECORDS']:
+        return jsonify({'error': 'too many records', 'max': app.config['BATCH_MAX_RECORDS']}), 413
+    result, errors = ingest_batch(items, get_current_user())
+    if errors:
+        db.session.rollback()
+        return jsonify({'error': 'invalid records', 'errors': errors}), 400
+    db.session.commit()
+    return jsonify(result)
+
+@app.route('/api/sync', methods=['GET', 'POST'])
+@login_required
+@serialized_writes
+def api_sync():
+    """Delta sync for offline clients: upload queued records and fetch changed reference data.
+
+    GET ?since=<version>, or POST {"since": <version>, "records": [...]} where records
+    use the /api/records/batch format. The response carries the new version to send
+    next time and `max_records`, the most records one upload may hold.
+    """
+    payload = request.get_json(silent=True) if request.method == 'POST' else None
+    payload = payload if isinstance(payload, dict) else {}
+    try:
+        since = int(payload.get('since', request.args.get('since', 0)) or 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'invalid since'}), 400
+    user = get_current_user()
+    result = {'inserted': 0, 'duplicates': []}
+    items = payload.get('records') or []
+    if not isinstance(items, list):
+        return jsonify({'error': 'invalid records'}), 400
+    if len(items) > app.config['BATCH_MAX_RECORDS']:
+        return jsonify({'error': 'too many records', 'max': app.config['BATCH_MAX_RECORDS']}), 413
+    if items:
+        result, errors = ingest_batch(items, user)
+        if errors:
+            db.session.rollback()
+            return jsonify({'error': 'invalid records', 'errors': errors}), 400
+        db.session.commit()
+    result.update(reference_delta(since, get_user_marathons(user)))
+    # Offline clients split their queue into uploads of at most this many records
+    result['max_records'] = app.config['BATCH_MAX_RECORDS']
+    return jsonify(result)
+
+@app.route('/api/marathons/<int:marathon_id>/unreturned')
+@login_required
+def api_unreturned(marathon_id):
+    """Outstanding equipment of a marathon, optionally for one ?station=<id>.
+
+    The ETag changes only when the marathon's balances or reference names change,
+    so clients polling with If-None-Match mostly get an empty 304.
+    """
+    access = get_user_access()
+    if not access or (access[0] not in ('admin', 'storekeeper') and marathon_id not in access[1]):
+        return jsonify({'error': 'forbidden'}), 403
+    station_id = request.args.get('station', type=int)
+    # Read the versions before the data so a concurrent write can only make the ETag older
+    etag = f'{marathon_id}-{station_id or 0}-{ledger_version(marathon_id)}-{reference_version()}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'marathon_id': marathon_id, 'station_id': station_id,
+                            'items': unreturned_items(marathon_id, station_id)})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/marathons/<int:marathon_id>/events')
+@login_required
+def api_marathon_events(marathon_id):
+    """Server-Sent Events with every new, edited or deleted record of a marathon.
+
+    Starts after the event id in Last-Event-ID (sent by the browser on reconnect) or
+    ?since=, which report pages set to the cursor they were rendered at.
+    """
+    access = get_user_access()
+    if not access or (access[0] not in ('admin', 'storekeeper') and marathon_id not in access[1]):
+        return jsonify({'error': 'forbidden'}), 403
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('since', type=int)
+    if cursor is None:
+        cursor = latest_event_id(marathon_id)
+    if not _event_stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'too many event streams'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    stream = event_stream(marathon_id, cursor, app.config['EVENTS_POLL_SECONDS'],
+                          app.config['EVENTS_KEEPALIVE_SECONDS'], app.config['EVENTS_STREAM_SECONDS'])
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    response.call_on_close(_event_stream_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # keep proxies from buffering the stream
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint aggregated over all gunicorn workers"""
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('unauthorized', status=401)
+    return render_metrics()
+
+@app.route('/sw.js')
+def service_worker():
+    """Serve the service worker from the site root so it can control every page"""
+    response = send_from_directory(app.static_folder, 'sw.js', max_age=0)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/persons')
 @login_required
 def api_persons():
-    persons = Person.query.order_by(Person.name).all(); return jsonify([p.name for p in persons])
+    if request.args.get('q'):
+        return jsonify([p['name'] for p in search_names('persons', request.args['q'])])
+    persons = reference_list('persons'); return jsonify([p.name for p in persons])
+
+@app.route('/api/search/<kind>')
+@login_required
+def api_search(kind):
+    """Prefix search on persons, equipments or stations: ?q=<text>&limit=<n>"""
+    if kind not in SEARCH_MODELS:
+        return jsonify({'error': 'unknown entity'}), 404
+    limit = min(max(request.args.get('limit', SEARCH_LIMIT, type=int), 1), SEARCH_MAX_LIMIT)
+    return jsonify(search_names(kind, request.args.get('q', ''), limit))
 
 # Admin routes
 @app.route('/admin/users')
@@ -633,19 +778,48 @@ def admin_delete_user(user_id):
     username = target_user.username
     db.session.delete(target_user)
     db.session.commit()
+    invalidate_user_access(user_id)
     flash(f'Người dùng {username} đã được xóa!', 'success')
     return redirect(url_for('admin_users'))
 
+@app.route('/admin/pool')
+@admin_required
+def admin_pool():
+    """Pool statistics of the worker that served the request"""
+    return jsonify(pool_stats())
+
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
+    """Dashboard shell; each tab loads its table from /admin/api/<section> when first shown"""
     user = get_current_user()
-    marathons = Marathon.query.order_by(Marathon.name).all()
-    stations = Station.query.order_by(Station.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
-    issue_records = IssueRecord.query.order_by(IssueRecord.timestamp.desc()).limit(100).all()
-    return_records = ReturnRecord.query.order_by(ReturnRecord.timestamp.desc()).limit(100).all()
-    return render_template('admin_dashboard.html', marathons=marathons, stations=stations, equipments=equipments, issue_records=issue_records, return_records=return_records, user=user)
+    # Cached lists, used only for the record filter dropdowns
+    marathons = reference_list('marathons')
+    stations = reference_list('stations')
+    equipments = reference_list('equipments')
+    profiles = recent_profiles(app)
+    profile_param = f"{PROFILE_PARAM}={profile_token(app, user.id)}"
+    return render_template('admin_dashboard.html', marathons=marathons, stations=stations, equipments=equipments,
+                           profiles=profiles, profile_param=profile_param, user=user)
+
+@app.route('/admin/api/<section>')
+@admin_required
+def admin_dashboard_section(section):
+    """One page of a dashboard section: ?page=&per_page=, plus q= for catalogues or
+    marathon=, station=, equipment=, user= for record history"""
+    if section not in DASHBOARD_SECTIONS:
+        return jsonify({'error': 'unknown section'}), 404
+    return jsonify(dashboard_section(
+        section, request.args.get('page', 1, type=int), request.args.get('per_page', DASHBOARD_PAGE_SIZE, type=int),
+        q=request.args.get('q', '').strip(), marathon_id=request.args.get('marathon', type=int),
+        station_id=request.args.get('station', type=int), equipment_id=request.args.get('equipment', type=int),
+        created_by=request.args.get('user', '').strip()))
+
+@app.route('/admin/profiles/<name>.prof')
+@admin_required
+def admin_profile_download(name):
+    """Raw cProfile output, for snakeviz or pstats"""
+    return send_from_directory(profiles_dir(app), f'{name}.prof', as_attachment=True)
 
 @app.route('/admin/delete/issue/<int:record_id>', methods=['POST'])
 @admin_required
@@ -654,7 +828,7 @@ def delete_issue_record(record_id):
     db.session.delete(record)
     db.session.commit()
     flash('Bản ghi xuất đã được xóa thành công!', 'success')
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('admin_dashboard') + '#issue-records')
 
 @app.route('/admin/delete/return/<int:record_id>', methods=['POST'])
 @admin_required
@@ -663,16 +837,16 @@ def delete_return_record(record_id):
     db.session.delete(record)
     db.session.commit()
     flash('Bản ghi nhập đã được xóa thành công!', 'success')
-    return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('admin_dashboard') + '#return-records')
 
 @app.route('/admin/edit/issue/<int:record_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_issue_record(record_id):
     user = get_current_user()
     record = IssueRecord.query.get_or_404(record_id)
-    marathons = Marathon.query.order_by(Marathon.name).all()
-    stations = Station.query.order_by(Station.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
+    marathons = reference_list('marathons')
+    stations = reference_list('stations')
+    equipments = reference_list('equipments')
     if request.method == 'POST':
         record.marathon_id = request.form.get('marathon') or None
         record.station_id = request.form.get('station') or None
@@ -681,7 +855,7 @@ def edit_issue_record(record_id):
         record.person_name = request.form.get('person')
         db.session.commit()
         flash('Bản ghi xuất đã được cập nhật thành công!', 'success')
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('admin_dashboard') + '#issue-records')
     return render_template('admin_edit_issue.html', record=record, marathons=marathons, stations=stations, equipments=equipments, user=user)
 
 @app.route('/admin/edit/return/<int:record_id>', methods=['GET', 'POST'])
@@ -689,9 +863,9 @@ def edit_issue_record(record_id):
 def edit_return_record(record_id):
     user = get_current_user()
     record = ReturnRecord.query.get_or_404(record_id)
-    marathons = Marathon.query.order_by(Marathon.name).all()
-    stations = Station.query.order_by(Station.name).all()
-    equipments = Equipment.query.order_by(Equipment.name).all()
+    marathons = reference_list('marathons')
+    stations = reference_list('stations')
+    equipments = reference_list('equipments')
     if request.method == 'POST':
         record.marathon_id = request.form.get('marathon') or None
         record.station_id = request.form.get('station') or None
@@ -700,7 +874,7 @@ def edit_return_record(record_id):
         record.person_name = request.form.get('person')
         db.session.commit()
         flash('Bản ghi nhập đã được cập nhật thành công!', 'success')
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('admin_dashboard') + '#return-records')
     return render_template('admin_edit_return.html', record=record, marathons=marathons, stations=stations, equipments=equipments, user=user)
 
 # Marathon management routes
@@ -742,6 +916,10 @@ def admin_delete_marathon(marathon_id):
 def admin_add_station_form():
     name = request.form.get('name')
     if name:
+        existing = name_taken(Station, name)
+        if existing:
+            flash(f'Trạm "{existing.name}" đã tồn tại!', 'danger')
+            return redirect(url_for('admin_dashboard') + '#stations')
         station = Station(name=name)
         db.session.add(station)
         db.session.commit()
@@ -754,6 +932,10 @@ def admin_edit_station(station_id):
     station = Station.query.get_or_404(station_id)
     name = request.form.get('name')
     if name:
+        existing = name_taken(Station, name, exclude_id=station_id)
+        if existing:
+            flash(f'Trạm "{existing.name}" đã tồn tại!', 'danger')
+            return redirect(url_for('admin_dashboard') + '#stations')
         station.name = name
         db.session.commit()
         flash(f'Trạm đã được cập nhật!', 'success')
@@ -775,6 +957,10 @@ def admin_delete_station(station_id):
 def admin_add_equipment_form():
     name = request.form.get('name')
     if name:
+        existing = name_taken(Equipment, name)
+        if existing:
+            flash(f'Thiết bị "{existing.name}" đã tồn tại!', 'danger')
+            return redirect(url_for('admin_dashboard') + '#equipments-manage')
         equipment = Equipment(name=name)
         db.session.add(equipment)
         db.session.commit()
@@ -787,6 +973,10 @@ def admin_edit_equipment(equipment_id):
     equipment = Equipment.query.get_or_404(equipment_id)
     name = request.form.get('name')
     if name:
+        existing = name_taken(Equipment, name, exclude_id=equipment_id)
+        if existing:
+            flash(f'Thiết bị "{existing.name}" đã tồn tại!', 'danger')
+            return redirect(url_for('admin_dashboard') + '#equipments-manage')
         equipment.name = name
         db.session.commit()
         flash(f'Thiết bị đã được cập nhật!', 'success')
@@ -863,6 +1053,7 @@ def admin_user_marathons(user_id):
                 target_user.assigned_marathons.append(marathon)
         
         db.session.commit()
+        invalidate_user_access(target_user.id)
         flash(f'Đã cập nhật phân công giải chạy cho {target_user.username}!', 'success')
         return redirect(url_for('admin_users'))
     
@@ -883,6 +1074,7 @@ def admin_change_user_role(user_id):
         if new_role in ['admin', 'user', 'storekeeper']:
             target_user.role = new_role
             db.session.commit()
+            invalidate_user_access(target_user.id)
             flash(f'Đã thay đổi vai trò của {target_user.username} thành {new_role}!', 'success')
             return redirect(url_for('admin_users'))
         else:
@@ -894,7 +1086,7 @@ def admin_change_user_role(user_id):
 @admin_required
 def admin_marathon_users():
     current_user = get_current_user()
-    marathons = Marathon.query.order_by(Marathon.name).all()
+    marathons = reference_list('marathons')
     all_users = User.query.filter(User.role == 'user').order_by(User.username).all()
     
     selected_marathon_id = request.args.get('marathon') or (marathons[0].id if marathons else None)
@@ -920,10 +1112,110 @@ def admin_marathon_users():
                 selected_marathon.assigned_users.append(user)
         
         db.session.commit()
+        invalidate_user_access()
         flash(f'Đã cập nhật phân công người dùng cho giải chạy "{selected_marathon.name}"!', 'success')
         return redirect(url_for('admin_marathon_users', marathon=marathon_id))
     
     return render_template('admin_marathon_users.html', marathons=marathons, all_users=all_users, 
                          selected_marathon=selected_marathon, user=current_user)
 
-if __name__=='__main__': app.run(debug=True)
+@app.cli.command('rebuild-balances')
+def rebuild_balances_command():
+    """Regenerate the StockBalance table from the raw record tables"""
+    count = rebuild_balances()
+    print(f"Rebuilt {count} balance rows")
+
+@app.cli.command('check-indexes')
+@click.option('--marathon', 'marathon_id', type=int, default=1, help='Marathon id used to parameterize the queries')
+def check_indexes_command(marathon_id):
+    """EXPLAIN the hot report queries and list those that hit sequential scans"""
+    for name, plan, scans in check_indexes(marathon_id):
+        print(f"{'SEQ SCAN' if scans else 'ok':8} {name}")
+        for line in scans:
+            print(f"           {line}")
+    print("Note: on small tables Postgres may prefer a sequential scan even when an index exists.")
+
+@app.cli.command('import-records')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--type', 'kind', type=click.Choice(list(RECORD_TYPES) + list(REFERENCE_LISTS)),
+              help='Record type for rows without a type column, or the reference list to load')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension')
+@click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE, show_default=True)
+@click.option('--created-by', default='import', show_default=True, help='Creator for rows without created_by')
+@click.option('--create-missing', is_flag=True, help='Create unknown marathons, stations and equipment')
+@click.option('--rejects', type=click.Path(dir_okay=False), help='Write rejected rows to this JSONL file')
+def import_records_command(path, kind, fmt, batch_size, created_by, create_missing, rejects):
+    """Bulk import records or reference data from a CSV or JSONL file in one transaction"""
+    items = read_items(path, fmt)
+    try:
+        if kind in REFERENCE_LISTS:
+            count, rejected = import_references(kind, items, batch_size)
+        else:
+            count, rejected = import_records(items, kind, created_by, create_missing, batch_size)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for line, error, _ in rejected[:20]:
+        print(f"  line {line}: {error}")
+    if len(rejected) > 20:
+        print(f"  ... {len(rejected) - 20} more")
+    if rejects and rejected:
+        with open(rejects, 'w', encoding='utf-8') as f:
+            for line, error, item in rejected:
+                f.write(json.dumps({'line': line, 'error': error, 'row': item}, ensure_ascii=False, default=str) + '\n')
+    print(f"Imported {count} rows, rejected {len(rejected)}")
+
+@app.cli.command('prune-events')
+@click.option('--hours', type=float, default=48, show_default=True, help='Keep events logged within this many hours')
+def prune_events_command(hours):
+    """Delete old record events; report pages older than this reload instead of catching up"""
+    count = prune_events(datetime.utcnow() - timedelta(hours=hours))
+    print(f"Deleted {count} record events")
+
+@app.cli.command('prune-idempotency-keys')
+@click.option('--hours', type=float, default=168, show_default=True, help='Keep keys claimed within this many hours')
+def prune_idempotency_keys_command(hours):
+    """Delete old upload idempotency keys; an upload retried after this long is ingested again"""
+    count = prune_idempotency_keys(datetime.utcnow() - timedelta(hours=hours))
+    print(f"Deleted {count} idempotency keys")
+
+@app.cli.command('close-marathon')
+@click.argument('marathon_id', type=int)
+@click.option('--by', 'closed_by', default='admin', show_default=True, help='Username recorded as closing the marathon')
+def close_marathon_command(marathon_id, closed_by):
+    """Freeze a finished marathon's totals and move its records to the archive tables"""
+    if db.session.get(Marathon, marathon_id) is None:
+        raise click.ClickException(f"No marathon {marathon_id}")
+    try:
+        count = close_marathon(marathon_id, closed_by)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    print(f"Archived {count} records of marathon {marathon_id}")
+
+@app.cli.command('reopen-marathon')
+@click.argument('marathon_id', type=int)
+def reopen_marathon_command(marathon_id):
+    """Move a closed marathon's archived records back into the record tables"""
+    if db.session.get(MarathonArchive, marathon_id) is None:
+        raise click.ClickException(f"Marathon {marathon_id} is not closed")
+    try:
+        count = reopen_marathon(marathon_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    print(f"Restored {count} records of marathon {marathon_id}")
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create or upgrade the database schema; run once per deploy before starting workers"""
+    version = migrate()
+    print(f"Schema at version {version}")
+
+if __name__=='__main__':
+    with app.app_context():
+        migrate()
+    app.run(debug=True)
@@ -0,0 +1,177 @@
+from sqlalchemy import event, func, select, union_all, literal_column
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session
+from models import db, StockBalance, LedgerVersion, IssueRecord, ReturnRecord, StoreIssueRecord, StoreReturnRecord
+
+# Equipment flows tracked per balance row, in store -> station -> store order
+FLOW_MODELS = (
+    ('store_issued', StoreIssueRecord),
+    ('issued', IssueRecord),
+    ('returned', ReturnRecord),
+    ('store_returned', StoreReturnRecord),
+)
+FLOW_BY_MODEL = {model: flow for flow, model in FLOW_MODELS}
+FLOWS = tuple(flow for flow, _ in FLOW_MODELS)
+
+# Key value used in StockBalance for records without a marathon or station
+NO_ID = 0
+
+
+def balance_key(marathon_id, station_id, equipment_id):
+    def _id(value):
+        return int(value) if value not in (None, '') else NO_ID
+    return (_id(marathon_id), _id(station_id), _id(equipment_id))
+
+
+def _record_key(record, values):
+    return balance_key(values('marathon_id'), values('station_id') if hasattr(record, 'station_id') else None, values('equipment_id'))
+
+
+def committed_value(record, attr):
+    """Value of `attr` as last loaded from the database (before any pending change)"""
+    history = sa_inspect(record).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(record, attr)
+
+
+def _add_delta(deltas, key, flow, quantity):
+    if not quantity:
+        return
+    row = deltas.setdefault(key, dict.fromkeys(FLOWS, 0))
+    row[flow] += int(quantity)
+
+
+def _dialect_insert(connection):
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def apply_balance_deltas(connection, deltas):
+    """Atomically add {key: {flow: delta}} to StockBalance with INSERT .. ON CONFLICT DO UPDATE.
+
+    Increments happen in SQL so concurrent workers never lose each other's updates.
+    Does not bump the LedgerVersion: events.log_events does that for every record write
+    in the same flush, so callers that log no events must bump it themselves.
+    """
+    deltas = {key: flows for key, flows in deltas.items() if any(flows.values())}
+    if not deltas:
+        return
+    add_flows(connection, StockBalance.__table__, deltas)
+
+
+def add_flows(connection, table, deltas):
+    """Upsert-add {key: {flow: delta}} into `table`, keyed by (marathon_id, station_id, equipment_id).
+
+    Rows are written in key order, like bump_ledger_versions, so concurrent
+    transactions lock shared balance rows in the same order and cannot deadlock.
+    """
+    stmt = _dialect_insert(connection)(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['marathon_id', 'station_id', 'equipment_id'],
+        set_={flow: table.c[flow] + stmt.excluded[flow] for flow in FLOWS}
+    )
+    connection.execute(stmt, [
+        dict(marathon_id=key[0], station_id=key[1], equipment_id=key[2], **flows)
+        for key, flows in sorted(deltas.items())
+    ])
+
+
+def bump_ledger_versions(connection, marathon_ids):
+    """Increment the LedgerVersion of each marathon, creating missing rows"""
+    if not marathon_ids:
+        return
+    table = LedgerVersion.__table__
+    stmt = _dialect_insert(connection)(table)
+    stmt = stmt.on_conflict_do_update(index_elements=['marathon_id'], set_={'version': table.c.version + 1})
+    connection.execute(stmt, [{'marathon_id': m, 'version': 1} for m in sorted(marathon_ids)])
+
+
+def ledger_version(marathon_id):
+    """Current LedgerVersion of a marathon (0 before its first record)"""
+    return db.session.query(LedgerVersion.version).filter_by(marathon_id=marathon_id).scalar() or 0
+
+
+def row_deltas(model, rows):
+    """Balance deltas for record rows (dicts) inserted outside the ORM unit of work"""
+    flow = FLOW_BY_MODEL[model]
+    deltas = {}
+    for row in rows:
+        _add_delta(deltas, balance_key(row.get('marathon_id'), row.get('station_id'), row['equipment_id']), flow, row.get('quantity'))
+    return deltas
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_record_changes(session, flush_context):
+    """Keep StockBalance in step with every insert, edit and delete of a record.
+
+    Runs inside the flush, so balances commit or roll back together with the records.
+    """
+    deltas = {}
+    for record in session.new:
+        flow = FLOW_BY_MODEL.get(type(record))
+        if flow:
+            _add_delta(deltas, _record_key(record, lambda attr: getattr(record, attr)), flow, record.quantity)
+    for record in session.deleted:
+        flow = FLOW_BY_MODEL.get(type(record))
+        if flow:
+            committed = lambda attr: committed_value(record, attr)
+            _add_delta(deltas, _record_key(record, committed), flow, -int(committed('quantity') or 0))
+    for record in session.dirty:
+        flow = FLOW_BY_MODEL.get(type(record))
+        if flow and session.is_modified(record):
+            committed = lambda attr: committed_value(record, attr)
+            _add_delta(deltas, _record_key(record, committed), flow, -int(committed('quantity') or 0))
+            _add_delta(deltas, _record_key(record, lambda attr: getattr(record, attr)), flow, record.quantity)
+    apply_balance_deltas(session.connection(), deltas)
+
+
+def ledger_query(marathon_id=None):
+    """UNION ALL of the four record tables summed per (marathon, station, equipment, flow)"""
+    selects = []
+    for flow, model in FLOW_MODELS:
+        stmt = select(
+            literal_column(f"'{flow}'").label('flow'),
+            func.coalesce(model.marathon_id, NO_ID).label('marathon_id'),
+            (func.coalesce(model.station_id, NO_ID) if hasattr(model, 'station_id') else literal_column(str(NO_ID))).label('station_id'),
+            model.equipment_id.label('equipment_id'),
+            model.quantity.label('quantity'),
+        )
+        if marathon_id:
+            stmt = stmt.where(model.marathon_id == marathon_id)
+        selects.append(stmt)
+    flows = union_all(*selects).subquery()
+    return select(
+        flows.c.marathon_id, flows.c.station_id, flows.c.equipment_id, flows.c.flow, func.sum(flows.c.quantity)
+    ).group_by(flows.c.marathon_id, flows.c.station_id, flows.c.equipment_id, flows.c.flow)
+
+
+def ledger_totals(marathon_id=None):
+    """Recompute balances from the raw record tables with a single UNION ALL query.
+
+    Returns {(marathon_id, station_id, equipment_id): {flow: total}} using NO_ID for
+    missing marathon/station ids.
+    """
+    rows = db.session.execute(ledger_query(marathon_id)).all()
+    totals = {}
+    for marathon, station, equipment, flow, qty in rows:
+        _add_delta(totals, balance_key(marathon, station, equipment), flow, qty or 0)
+    return totals
+
+
+def rebuild_balances():
+    """Regenerate the whole StockBalance table from the raw record tables"""
+    totals = ledger_totals()
+    marathon_ids = {m for (m,) in db.session.query(StockBalance.marathon_id).distinct()}
+    db.session.query(StockBalance).delete()
+    apply_balance_deltas(db.session.connection(), totals)
+    # No events are logged here, so invalidate the cached views of every marathon touched,
+    # including those left without any balance rows
+    bump_ledger_versions(db.session.connection(), marathon_ids | {key[0] for key in totals})
+    db.session.commit()
+    return len(totals)
@@ -0,0 +1,4 @@
+"""Synthetic data, route benchmarks and load tests for be-rao.
+
+Run from the repository root, e.g. `python -m benchmarks.routes --scale small`.
+"""
@@ -0,0 +1,52 @@
+import json
+import math
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'instance', 'benchmarks')
+
+
+def default_database_url(scale):
+    return f"sqlite:///{os.path.join(RESULTS_DIR, f'bench-{scale}.db')}"
+
+
+def load_app(database_url):
+    """Import the Flask app bound to `database_url`.
+
+    app.py reads its configuration from the environment at import time, so this must
+    run before anything else imports it. The slow-request log is silenced because
+    every benchmark request would trip it on large scales.
+    """
+    if 'app' in sys.modules:
+        raise RuntimeError('app was imported before load_app()')
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SERVER_TIMING', '1')
+    os.environ.setdefault('QUERY_LOG_COUNT', str(10 ** 9))
+    os.environ.setdefault('QUERY_LOG_MS', str(10 ** 9))
+    from app import app
+    return app
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0..100) of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,71 @@
+"""Compare two route benchmark results and flag regressions.
+
+    python -m benchmarks.compare OLD.json NEW.json [--threshold 0.2]
+
+Exits with status 1 when a route's p95 grew by more than the threshold (a fraction)
+by at least --min-ms, or it runs more queries than before.
+"""
+import argparse
+import json
+import sys
+
+
+def _change(old, new):
+    if old is None or new is None:
+        return ''
+    if not old:
+        return ''
+    return f'{(new - old) / old:+.0%}'
+
+
+def compare(old, new, threshold, min_ms=1.0):
+    """Printable lines and the names of regressed routes"""
+    lines, regressions = [], []
+    for key in ('database', 'scale', 'seed', 'data'):
+        if old['meta'].get(key) != new['meta'].get(key):
+            lines.append(f"warning: {key} differs ({old['meta'].get(key)} -> {new['meta'].get(key)})")
+    lines.append(f"{'route':26} {'p50 ms':>21} {'p95 ms':>21} {'queries':>11} {'peak KiB':>21}")
+    for name, after in new['routes'].items():
+        before = old['routes'].get(name)
+        if before is None:
+            lines.append(f'{name:26} new route')
+            continue
+        growth = after['p95_ms'] - before['p95_ms']
+        # The absolute floor keeps jitter on millisecond routes from failing the comparison
+        regressed = (growth >= min_ms and before['p95_ms'] and growth / before['p95_ms'] > threshold) \
+            or (after['queries'] or 0) > (before['queries'] or 0)
+        if regressed:
+            regressions.append(name)
+        lines.append(
+            f"{name:26} {before['p50_ms']:8.1f} {after['p50_ms']:8.1f} {_change(before['p50_ms'], after['p50_ms']):>4} "
+            f"{before['p95_ms']:8.1f} {after['p95_ms']:8.1f} {_change(before['p95_ms'], after['p95_ms']):>4} "
+            f"{before['queries'] if before['queries'] is not None else '?':>5} {after['queries'] if after['queries'] is not None else '?':>5} "
+            f"{before['peak_kib']:8.0f} {after['peak_kib']:8.0f} {_change(before['peak_kib'], after['peak_kib']):>4}"
+            + ('  REGRESSION' if regressed else ''))
+    for name in old['routes']:
+        if name not in new['routes']:
+            lines.append(f'{name:26} missing from new results')
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative p95 growth (default 0.2)')
+    parser.add_argument('--min-ms', type=float, default=1.0, help='Ignore p95 growth below this many ms (default 1)')
+    args = parser.parse_args()
+    with open(args.old, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    lines, regressions = compare(old, new, args.threshold, args.min_ms)
+    print('\n'.join(lines))
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
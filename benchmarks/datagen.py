@@ -0,0 +1,178 @@
+"""Seeded synthetic race data: marathons, stations, equipment, persons, volunteers and records.
+
+    python -m benchmarks.datagen --scale large [--database-url URL] [--seed 1] [--reset]
+
+The same scale and seed on an empty database always produce the same rows and ids.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from benchmarks.common import default_database_url, load_app
+from balances import rebuild_balances
+from migrations import migrate
+from models import db, Marathon, Station, Equipment, Person, User
+from names import normalize_name
+from records import RECORD_TYPES
+
+SCALES = {
+    'tiny': dict(marathons=2, stations=10, equipment=20, persons=50, users=10, records=5_000),
+    'small': dict(marathons=3, stations=30, equipment=50, persons=200, users=50, records=50_000),
+    'medium': dict(marathons=5, stations=60, equipment=100, persons=500, users=200, records=250_000),
+    'large': dict(marathons=10, stations=100, equipment=200, persons=1_000, users=500, records=1_000_000),
+}
+# Share of each record type; stations issue and return far more often than the store moves stock
+RECORD_MIX = {'store_issue': 0.1, 'issue': 0.4, 'return': 0.4, 'store_return': 0.1}
+USER_PASSWORD = 'bench'  # password of every synthetic volunteer account
+CHUNK = 10_000  # record rows per INSERT batch and commit
+
+_EQUIPMENT = ['Rào chắn', 'Cọc tiêu', 'Bàn gấp', 'Ghế nhựa', 'Lều bạt', 'Bộ đàm', 'Thùng nước', 'Áo tình nguyện',
+              'Cờ hiệu', 'Loa cầm tay', 'Băng rôn', 'Thùng rác', 'Đèn pin', 'Dây phân làn', 'Biển chỉ dẫn']
+_FAMILY = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ', 'Hồ', 'Ngô']
+_MIDDLE = ['Văn', 'Thị', 'Hữu', 'Minh', 'Thanh', 'Ngọc', 'Đức', 'Quang', 'Thu', 'Gia']
+_GIVEN = ['An', 'Bình', 'Châu', 'Dũng', 'Đức', 'Giang', 'Hà', 'Hải', 'Hạnh', 'Hiếu', 'Hoa', 'Hùng', 'Khoa', 'Lan',
+          'Linh', 'Long', 'Mai', 'Nam', 'Nga', 'Phúc', 'Quân', 'Sơn', 'Tâm', 'Thảo', 'Trang', 'Tuấn', 'Vy', 'Yến']
+_RACE_DAY = datetime(2026, 3, 1, 4, 0)  # first marathon starts here, the next ones a week apart
+
+
+def add_scale_arguments(parser):
+    """Options shared by the benchmark commands to pick or override a data scale"""
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database-url', help='Defaults to a SQLite file per scale under instance/benchmarks/')
+    parser.add_argument('--reset', action='store_true', help='Drop all tables and generate the data again')
+    for name in SCALES['tiny']:
+        parser.add_argument(f'--{name}', type=int, help=f'Override the number of {name} of the scale')
+
+
+def scale_from_args(args):
+    scale = dict(SCALES[args.scale])
+    scale.update({name: getattr(args, name) for name in scale if getattr(args, name) is not None})
+    return scale
+
+
+def _person_names(rng, count):
+    names, keys = [], set()
+    while len(names) < count:
+        name = f'{rng.choice(_FAMILY)} {rng.choice(_MIDDLE)} {rng.choice(_GIVEN)}'
+        if normalize_name(name) in keys:
+            name = f'{name} {len(names) + 1}'
+        keys.add(normalize_name(name))
+        names.append(name)
+    return names
+
+
+def _add_named(model, names, **fields):
+    objects = [model(name=name, **fields) for name in names]
+    db.session.add_all(objects)
+    db.session.flush()
+    return [obj.id for obj in objects]
+
+
+def generate(scale, seed=1, report=print):
+    """Populate an empty, migrated database; returns describe() of the result"""
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    marathon_ids = _add_named(Marathon, [f'Giải chạy {i:02d}' for i in range(1, scale['marathons'] + 1)])
+    station_ids = _add_named(Station, [f'Trạm {i:03d}' for i in range(1, scale['stations'] + 1)])
+    equipment_ids = _add_named(Equipment, [f'{_EQUIPMENT[i % len(_EQUIPMENT)]} {i // len(_EQUIPMENT) + 1:02d}'
+                                           for i in range(scale['equipment'])], available_quantity=1000)
+    persons = _person_names(rng, scale['persons'])
+    _add_named(Person, persons)
+    # One password hash for every volunteer: hashing thousands of passwords would dominate setup
+    template = User(username='_')
+    template.set_password(USER_PASSWORD)
+    marathons = {m.id: m for m in Marathon.query}
+    volunteers = []
+    for i in range(1, scale['users'] + 1):
+        user = User(username=f'tnv{i:04d}', password_hash=template.password_hash, role='user')
+        user.assigned_marathons.append(marathons[marathon_ids[(i - 1) % len(marathon_ids)]])
+        volunteers.append(user)
+    db.session.add_all(volunteers)
+    db.session.commit()
+    report(f"reference data in {time.perf_counter() - started:.1f}s")
+
+    usernames = [u.username for u in volunteers] or ['admin']
+    kinds = list(RECORD_MIX)
+    weights = [RECORD_MIX[k] for k in kinds]
+    buffers = {kind: [] for kind in kinds}
+
+    def flush(kind):
+        if buffers[kind]:
+            db.session.execute(insert(RECORD_TYPES[kind].__table__), buffers[kind])
+            buffers[kind] = []
+
+    for n in range(scale['records']):
+        kind = rng.choices(kinds, weights)[0]
+        m = rng.randrange(len(marathon_ids))
+        row = {
+            'marathon_id': marathon_ids[m],
+            'equipment_id': rng.choice(equipment_ids),
+            'quantity': rng.randint(1, 10),
+            'person_name': rng.choice(persons),
+            'timestamp': _RACE_DAY + timedelta(days=7 * m, seconds=rng.randrange(8 * 3600)),
+            'created_by': rng.choice(usernames),
+        }
+        if kind in ('issue', 'return'):
+            row['station_id'] = rng.choice(station_ids)
+        buffers[kind].append(row)
+        if len(buffers[kind]) >= CHUNK:
+            flush(kind)
+        if (n + 1) % (CHUNK * 10) == 0:
+            db.session.commit()
+            report(f"{n + 1} records in {time.perf_counter() - started:.1f}s")
+    for kind in kinds:
+        flush(kind)
+    db.session.commit()
+    balances = rebuild_balances()
+    report(f"{scale['records']} records and {balances} balance rows in {time.perf_counter() - started:.1f}s")
+    return describe()
+
+
+def describe():
+    """Ids and row counts of the data in the database, used to build benchmark requests"""
+    return {
+        'marathon_ids': [id for (id,) in db.session.query(Marathon.id).order_by(Marathon.id)],
+        'station_ids': [id for (id,) in db.session.query(Station.id).order_by(Station.id)],
+        'equipment_ids': [id for (id,) in db.session.query(Equipment.id).order_by(Equipment.id)],
+        'usernames': [name for (name,) in db.session.query(User.username).filter(User.username.like('tnv%')).order_by(User.username)],
+        'persons': db.session.query(Person).count(),
+        'records': {kind: db.session.query(model).count() for kind, model in RECORD_TYPES.items()},
+    }
+
+
+def prepare(app, scale, seed=1, reset=False, report=print):
+    """Migrate the database and generate data unless it already holds the scale's records; returns describe()"""
+    with app.app_context():
+        if reset:
+            db.drop_all()
+        migrate(report=lambda message: None)
+        existing = describe()
+        count = sum(existing['records'].values())
+        if count:
+            # Runs are only comparable on the data exactly as generated
+            if count != scale['records']:
+                raise SystemExit(f"the database holds {count} records, not the {scale['records']} of this scale; "
+                                 "pass --reset to generate it again")
+            report(f"reusing existing data: {count} records (--reset to regenerate)")
+            return existing
+        return generate(scale, seed, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a database with seeded synthetic race data')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    app = load_app(args.database_url or default_database_url(args.scale))
+    summary = prepare(app, scale_from_args(args), args.seed, args.reset)
+    print(f"{len(summary['marathon_ids'])} marathons, {len(summary['station_ids'])} stations, "
+          f"{len(summary['equipment_ids'])} equipment, {len(summary['usernames'])} volunteers, "
+          f"{sum(summary['records'].values())} records")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""Race-morning load test: many volunteers issuing, returning and refreshing at once.
+
+    python -m benchmarks.load --scale small [--ramp 5,10,25,50] [--stage-seconds 30]
+        [--mix issue=30,return=30,lookup=25,report=15] [--think 0.5] [--url http://host:port]
+
+The data comes from benchmarks.datagen (same --scale/--seed/--database-url). Without
+--url a gunicorn server is started with gunicorn.conf.py, so WEB_CONCURRENCY/WEB_THREADS
+and the DB_* settings apply as in production. Because the test writes records, that
+server runs on a fresh copy of the generated SQLite file (other databases are
+regenerated before every run); with --url the server must use a freshly generated
+database of the same scale and seed. Each virtual user logs in as one of
+the tnvNNNN volunteers, stays at one station of its assigned marathon and loops over
+the mix with exponential think time; concurrency steps up through --ramp and every
+stage reports throughput, error rate and latency percentiles per endpoint.
+"""
+import argparse
+import http.client
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+from sqlalchemy.engine import make_url
+
+from benchmarks.common import (RESULTS_DIR, ROOT, default_database_url, git_commit, load_app, percentile,
+                               write_json)
+from benchmarks.datagen import USER_PASSWORD, add_scale_arguments, prepare, scale_from_args
+
+DEFAULT_MIX = 'issue=30,return=30,lookup=25,report=15'
+ENDPOINTS = ('issue', 'return', 'lookup', 'report')
+SERVER_START_SECONDS = 30
+REQUEST_TIMEOUT = 60  # seconds; slower requests count as errors
+
+
+def parse_mix(text):
+    """'issue=30,report=10' -> {'issue': 30.0, 'report': 10.0}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"unknown endpoint '{name}' (choose from {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('the mix needs at least one positive weight')
+    return mix
+
+
+class Client:
+    """One volunteer's browser: a keep-alive connection and the session cookie"""
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.cookies = {}
+        self.connection = None
+
+    def request(self, method, path, form=None):
+        """(status, Location header); the body is read and discarded"""
+        headers = {'Cookie': '; '.join(f'{k}={v}' for k, v in self.cookies.items())}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = cookie.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        if response.will_close:
+            self.close()
+        return response.status, response.headers.get('Location', '')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Recorder:
+    """Collects (stage, endpoint, ms, ok) samples from every user thread"""
+    def __init__(self):
+        self.stage = 0
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, endpoint, ms, ok):
+        with self._lock:
+            self.samples.append((stage, endpoint, ms, ok))
+
+    def summary(self, stage, seconds):
+        with self._lock:
+            samples = [s for s in self.samples if s[0] == stage]
+        endpoints = {}
+        for name in ENDPOINTS + ('login',):
+            timings = [ms for _, endpoint, ms, _ in samples if endpoint == name]
+            if not timings:
+                continue
+            errors = sum(1 for _, endpoint, _, ok in samples if endpoint == name and not ok)
+            endpoints[name] = {
+                'requests': len(timings),
+                'rps': round(len(timings) / seconds, 2),
+                'error_rate': round(errors / len(timings), 4),
+                'p50_ms': round(percentile(timings, 50), 1),
+                'p95_ms': round(percentile(timings, 95), 1),
+                'p99_ms': round(percentile(timings, 99), 1),
+                'max_ms': round(max(timings), 1),
+            }
+        measured = [s for s in samples if s[1] != 'login']
+        return {'requests': len(measured), 'rps': round(len(measured) / seconds, 2),
+                'errors': sum(1 for s in measured if not s[3]), 'endpoints': endpoints}
+
+
+class Volunteer(threading.Thread):
+    """A virtual station volunteer looping over the request mix until stopped"""
+    def __init__(self, number, base_url, username, marathon_id, station_id, equipment_ids, mix, think, seed,
+                 recorder, stop):
+        super().__init__(name=f'volunteer-{number}', daemon=True)
+        self.client = Client(base_url)
+        self.username, self.marathon_id, self.station_id = username, marathon_id, station_id
+        self.equipment_ids = equipment_ids
+        self.endpoints, self.weights = list(mix), list(mix.values())
+        self.think = think
+        self.rng = random.Random(seed * 100_003 + number)
+        self.recorder, self.stop = recorder, stop
+
+    def _timed(self, endpoint, method, path, form=None, expect=200, stage=None):
+        stage = self.recorder.stage if stage is None else stage
+        started = time.perf_counter()
+        try:
+            status, location = self.client.request(method, path, form)
+            # A redirect to the login page means the session was lost
+            ok = status == expect and '/login' not in location
+        except (OSError, http.client.HTTPException):
+            ok = False
+        self.recorder.add(stage, endpoint, (time.perf_counter() - started) * 1000, ok)
+        return ok
+
+    def login(self, stage):
+        return self._timed('login', 'POST', '/login', {'username': self.username, 'password': USER_PASSWORD},
+                           expect=302, stage=stage)
+
+    def _items(self):
+        equipment = self.rng.sample(self.equipment_ids, min(self.rng.randint(1, 3), len(self.equipment_ids)))
+        return [('equipment[]', e) for e in equipment] + [('quantity[]', self.rng.randint(1, 5)) for _ in equipment]
+
+    def step(self):
+        endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+        if endpoint in ('issue', 'return'):
+            form = [('marathon', self.marathon_id), ('station', self.station_id)] + self._items()
+            self._timed(endpoint, 'POST', f'/{endpoint}', form, expect=302)
+        elif endpoint == 'lookup':
+            self._timed(endpoint, 'GET', f'/return?marathon={self.marathon_id}')
+        else:
+            self._timed(endpoint, 'GET', f'/report?marathon={self.marathon_id}')
+
+    def run(self):
+        while not self.stop.is_set():
+            self.step()
+            if self.think:
+                self.stop.wait(self.rng.expovariate(1 / self.think))
+        self.client.close()
+
+
+def start_server(database_url, port, environ, log_path):
+    """Run gunicorn with the production config on `database_url`; returns the process"""
+    env = dict(environ, DATABASE_URL=database_url, PORT=str(port))
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                                   cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with {process.returncode}, see {log_path}')
+        try:
+            if Client(f'http://127.0.0.1:{port}').request('GET', '/login')[0] == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'gunicorn did not answer within {SERVER_START_SECONDS}s, see {log_path}')
+
+
+def fresh_copy(database_url):
+    """Copy a generated SQLite database to a scratch file for one run; returns its URL"""
+    source = make_url(database_url).database
+    target = os.path.join(RESULTS_DIR, f'load-{os.path.basename(source)}')
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+    return f'sqlite:///{target}'
+
+
+def assignments(app):
+    """Volunteer username -> id of its first assigned marathon"""
+    from models import User
+    with app.app_context():
+        return {u.username: u.assigned_marathons[0].id
+                for u in User.query.filter(User.username.like('tnv%')).order_by(User.username)
+                if u.assigned_marathons}
+
+
+def print_stage(number, concurrency, result):
+    print(f"stage {number}: {concurrency} users, {result['rps']} req/s, {result['errors']} errors")
+    for name, r in result['endpoints'].items():
+        print(f"  {name:8} {r['requests']:6} req {r['rps']:7.1f}/s  err {r['error_rate']:6.1%}  "
+              f"p50 {r['p50_ms']:7.1f}  p95 {r['p95_ms']:7.1f}  p99 {r['p99_ms']:7.1f}  max {r['max_ms']:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test with concurrent synthetic volunteers')
+    add_scale_arguments(parser)
+    parser.add_argument('--url', help='Test a running server instead of starting gunicorn')
+    parser.add_argument('--port', type=int, default=8765, help='Port of the gunicorn started without --url')
+    parser.add_argument('--ramp', default='5,10,25,50', help='Concurrent users of each stage')
+    parser.add_argument('--stage-seconds', type=float, default=30)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Endpoint weights (default {DEFAULT_MIX})')
+    parser.add_argument('--think', type=float, default=0.5, help='Mean seconds between a user\'s requests')
+    parser.add_argument('--out', help='Result file; defaults to instance/benchmarks/load-<scale>-<database>-<commit>.json')
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+        ramp = [int(n) for n in args.ramp.split(',')]
+    except ValueError as e:
+        parser.error(str(e))
+    if not ramp or min(ramp) < 1 or ramp != sorted(ramp):
+        parser.error('--ramp needs increasing user counts, e.g. 5,10,25')
+
+    environ = dict(os.environ)  # the server should not inherit load_app's benchmark settings
+    database_url = args.database_url or default_database_url(args.scale)
+    sqlite = database_url.startswith('sqlite')
+    app = load_app(database_url)
+    # The generated data is never written to, except a non-SQLite database the server runs on
+    summary = prepare(app, scale_from_args(args), args.seed, args.reset or not (sqlite or args.url))
+    volunteers = assignments(app)
+    if not volunteers:
+        parser.error('no tnvNNNN volunteers in the database; regenerate with --reset')
+    usernames = sorted(volunteers)
+    dialect = database_url.split(':', 1)[0].split('+', 1)[0]
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        log_path = os.path.join(RESULTS_DIR, 'load-server.log')
+        server_url = fresh_copy(database_url) if sqlite else database_url
+        server = start_server(server_url, args.port, environ, log_path)
+        base_url = f'http://127.0.0.1:{args.port}'
+        print(f'gunicorn on {base_url}, log in {log_path}')
+
+    recorder, stop = Recorder(), threading.Event()
+    station_rng = random.Random(args.seed)
+    users, stages = [], []
+    try:
+        for number, concurrency in enumerate(ramp, 1):
+            recorder.stage = 0  # requests made while new users log in are not counted
+            while len(users) < concurrency:
+                # More users than volunteers share accounts, like a station sharing a login
+                username = usernames[len(users) % len(usernames)]
+                user = Volunteer(len(users), base_url, username, volunteers[username],
+                                 station_rng.choice(summary['station_ids']), summary['equipment_ids'],
+                                 mix, args.think, args.seed, recorder, stop)
+                if not user.login(number):
+                    raise SystemExit(f'{username} could not log in to {base_url}')
+                user.start()
+                users.append(user)
+            started = time.monotonic()
+            recorder.stage = number
+            time.sleep(args.stage_seconds)
+            result = dict(recorder.summary(number, time.monotonic() - started), users=concurrency)
+            stages.append(result)
+            print_stage(number, concurrency, result)
+    finally:
+        stop.set()
+        for user in users:
+            user.join(REQUEST_TIMEOUT)
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    commit = git_commit()
+    result = {
+        'meta': {
+            'commit': commit,
+            'created': datetime.utcnow().isoformat(timespec='seconds'),
+            'database': dialect,
+            'url': args.url,
+            'scale': args.scale,
+            'seed': args.seed,
+            'mix': mix,
+            'think_seconds': args.think,
+            'stage_seconds': args.stage_seconds,
+            'workers': environ.get('WEB_CONCURRENCY'),
+            'threads': environ.get('WEB_THREADS'),
+            'records': summary['records'],
+            'python': platform.python_version(),
+        },
+        'stages': stages,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"load-{args.scale}-{dialect}-{commit or 'nogit'}.json")
+    write_json(out, result)
+    print(f"Wrote {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Time the heavy pages with Flask's test client and write a JSON baseline.
+
+    python -m benchmarks.routes --scale small [--iterations 20] [--out FILE]
+    python -m benchmarks.compare OLD.json NEW.json
+
+Each route is requested `--warmup` times, then timed `--iterations` times; query
+counts come from the Server-Timing header and peak Python memory from one extra
+request under tracemalloc. Pass --database-url postgresql://... to run on Postgres.
+"""
+import argparse
+import os
+import platform
+import resource
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.common import RESULTS_DIR, default_database_url, git_commit, load_app, percentile, write_json
+from benchmarks.datagen import add_scale_arguments, prepare, scale_from_args
+
+
+def bench_routes(summary):
+    """(name, path) of the benchmarked GET routes, on the first generated marathon and station"""
+    marathon, station = summary['marathon_ids'][0], summary['station_ids'][0]
+    return [
+        ('report', f'/report?marathon={marathon}'),
+        ('reconciliation_report', f'/reconciliation_report?marathon={marathon}'),
+        ('return_equipment', f'/return?marathon={marathon}'),
+        ('return_equipment_station', f'/return?marathon={marathon}&station={station}'),
+        ('store_return', f'/store_return?marathon={marathon}'),
+        ('issue', '/issue'),
+        ('api_unreturned', f'/api/marathons/{marathon}/unreturned'),
+        ('admin_issue_records', f'/admin/api/issue_records?marathon={marathon}'),
+    ]
+
+
+def _query_count(server_timing):
+    for part in (server_timing or '').split(','):
+        name, _, value = part.strip().partition(';desc=')
+        if name == 'db-count':
+            return int(value)
+    return None
+
+
+def measure(client, path, iterations, warmup):
+    """Latency percentiles (ms), query count and peak traced memory (KiB) of GET `path`"""
+    for _ in range(warmup):
+        client.get(path).get_data()
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        timings.append((time.perf_counter() - started) * 1000)
+    tracemalloc.start()
+    client.get(path).get_data()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'path': path,
+        'status': response.status_code,
+        'queries': _query_count(response.headers.get('Server-Timing')),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'mean_ms': round(sum(timings) / len(timings), 2),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the report and return pages')
+    add_scale_arguments(parser)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--route', action='append', help='Only run these routes (repeatable)')
+    parser.add_argument('--out', help='Result file; defaults to instance/benchmarks/<scale>-<database>-<commit>.json')
+    args = parser.parse_args()
+
+    database_url = args.database_url or default_database_url(args.scale)
+    app = load_app(database_url)
+    scale = scale_from_args(args)
+    summary = prepare(app, scale, args.seed, args.reset)
+    dialect = database_url.split(':', 1)[0].split('+', 1)[0]
+
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    if response.status_code != 302:
+        parser.error('could not log in as admin/admin123')
+    results = {}
+    for name, path in bench_routes(summary):
+        if args.route and name not in args.route:
+            continue
+        results[name] = measure(client, path, args.iterations, args.warmup)
+        r = results[name]
+        print(f"{name:26} {r['status']} p50 {r['p50_ms']:8.1f} ms  p95 {r['p95_ms']:8.1f} ms  "
+              f"{r['queries'] if r['queries'] is not None else '?':>4} queries  {r['peak_kib']:9.0f} KiB")
+
+    commit = git_commit()
+    baseline = {
+        'meta': {
+            'commit': commit,
+            'created': datetime.utcnow().isoformat(timespec='seconds'),
+            'database': dialect,
+            'scale': args.scale,
+            'seed': args.seed,
+            'data': {'marathons': len(summary['marathon_ids']), 'stations': len(summary['station_ids']),
+                     'equipment': len(summary['equipment_ids']), 'records': summary['records']},
+            'iterations': args.iterations,
+            'python': platform.python_version(),
+            # ru_maxrss is KiB on Linux, bytes on macOS
+            'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if platform.system() == 'Darwin' else 1),
+        },
+        'routes': results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{args.scale}-{dialect}-{commit or 'nogit'}.json")
+    write_json(out, baseline)
+    print(f"Wrote {out}")
+
+
+if __name__ == '__main__':
+    main()
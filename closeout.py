@@ -0,0 +1,90 @@
+from datetime import datetime
+from sqlalchemy import delete, insert, select
+from models import db, StockBalance, MarathonSummary, MarathonArchive, RECORD_ARCHIVES
+from balances import FLOWS, FLOW_MODELS, row_deltas, apply_balance_deltas, add_flows
+from events import log_reload
+
+# Closing a marathon moves its records out of the hot record tables into the *_archive
+# tables and folds their totals into MarathonSummary, so reports keep the same numbers
+# while the record tables (and every unfiltered query on them) only hold active races.
+ARCHIVE_BATCH = 5000  # records moved per SELECT/INSERT/DELETE round
+
+
+def _negate(deltas):
+    return {key: {flow: -quantity for flow, quantity in flows.items()} for key, flows in deltas.items()}
+
+
+def _merge(total, deltas):
+    for key, flows in deltas.items():
+        row = total.setdefault(key, dict.fromkeys(FLOWS, 0))
+        for flow, quantity in flows.items():
+            row[flow] += quantity
+
+
+def _drop_empty_balances(connection, marathon_id):
+    connection.execute(delete(StockBalance).where(
+        StockBalance.marathon_id == marathon_id, *[getattr(StockBalance, flow) == 0 for flow in FLOWS]))
+
+
+def close_marathon(marathon_id, closed_by=None):
+    """Archive a marathon's records and freeze their totals; returns the number of records moved.
+
+    Rows are locked, copied and deleted by id in batches, and exactly their totals
+    are moved from StockBalance to MarathonSummary, so records written while this
+    runs stay in the hot tables and are counted once. Closing again later archives
+    such stragglers too. The caller commits.
+    """
+    connection = db.session.connection()
+    moved, deltas = 0, {}
+    for _, model in FLOW_MODELS:
+        table, archive = model.__table__, RECORD_ARCHIVES[model]
+        while True:
+            rows = connection.execute(select(table).where(table.c.marathon_id == marathon_id)
+                                      .order_by(table.c.id).limit(ARCHIVE_BATCH).with_for_update()).mappings().all()
+            if not rows:
+                break
+            rows = [dict(row) for row in rows]
+            connection.execute(insert(archive), rows)
+            connection.execute(delete(table).where(table.c.id.in_([row['id'] for row in rows])))
+            _merge(deltas, row_deltas(model, rows))
+            moved += len(rows)
+    deltas = {key: flows for key, flows in deltas.items() if any(flows.values())}
+    if deltas:
+        add_flows(connection, MarathonSummary.__table__, deltas)
+    apply_balance_deltas(connection, _negate(deltas))
+    _drop_empty_balances(connection, marathon_id)
+    closeout = db.session.get(MarathonArchive, marathon_id) or MarathonArchive(marathon_id=marathon_id, records=0)
+    closeout.closed_at = datetime.utcnow()
+    closeout.closed_by = closed_by
+    closeout.records += moved
+    db.session.add(closeout)
+    # Also bumps the LedgerVersion; open report pages reload rather than look up moved records
+    log_reload(db.session, [marathon_id])
+    return moved
+
+
+def reopen_marathon(marathon_id):
+    """Move a closed marathon's archived records back and drop its summary; returns the number restored.
+
+    Restored records get new ids (ids of archived rows may have been reused since).
+    The caller commits.
+    """
+    connection = db.session.connection()
+    restored, deltas = 0, {}
+    for _, model in FLOW_MODELS:
+        archive = RECORD_ARCHIVES[model]
+        while True:
+            rows = connection.execute(select(archive).where(archive.c.marathon_id == marathon_id)
+                                      .order_by(archive.c.archive_id).limit(ARCHIVE_BATCH)).mappings().all()
+            if not rows:
+                break
+            connection.execute(insert(model.__table__), [
+                {name: value for name, value in row.items() if name not in ('archive_id', 'id')} for row in rows])
+            connection.execute(delete(archive).where(archive.c.archive_id.in_([row['archive_id'] for row in rows])))
+            _merge(deltas, row_deltas(model, rows))
+            restored += len(rows)
+    connection.execute(delete(MarathonSummary).where(MarathonSummary.marathon_id == marathon_id))
+    connection.execute(delete(MarathonArchive).where(MarathonArchive.marathon_id == marathon_id))
+    apply_balance_deltas(connection, deltas)
+    log_reload(db.session, [marathon_id])
+    return restored
@@ -0,0 +1,82 @@
+from flask import url_for
+from sqlalchemy import func, select
+from models import db, Marathon, Station, Equipment, IssueRecord, ReturnRecord
+from history import transaction_history_query
+
+DASHBOARD_PAGE_SIZE = 50
+DASHBOARD_MAX_PAGE_SIZE = 200
+
+# Catalogue section -> (model, {action url key: (endpoint, id argument)})
+CATALOGUE_SECTIONS = {
+    'equipments': (Equipment, {'edit_url': ('admin_edit_equipment', 'equipment_id'),
+                               'delete_url': ('admin_delete_equipment', 'equipment_id'),
+                               'quantity_url': ('admin_set_available_quantity', 'equipment_id')}),
+    'stations': (Station, {'edit_url': ('admin_edit_station', 'station_id'),
+                           'delete_url': ('admin_delete_station', 'station_id')}),
+    'marathons': (Marathon, {'edit_url': ('admin_edit_marathon', 'marathon_id'),
+                             'delete_url': ('admin_delete_marathon', 'marathon_id')}),
+}
+# Record section -> (stream, {action url key: endpoint})
+RECORD_SECTIONS = {
+    'issue_records': (('issue', IssueRecord), {'edit_url': 'edit_issue_record', 'delete_url': 'delete_issue_record'}),
+    'return_records': (('return', ReturnRecord), {'edit_url': 'edit_return_record', 'delete_url': 'delete_return_record'}),
+}
+SECTIONS = tuple(CATALOGUE_SECTIONS) + tuple(RECORD_SECTIONS)
+
+
+def _page(stmt, page, per_page):
+    """(rows as mappings, total row count) for one LIMIT/OFFSET page of `stmt`"""
+    total = db.session.execute(select(func.count()).select_from(stmt.order_by(None).subquery())).scalar()
+    rows = db.session.execute(stmt.limit(per_page).offset((page - 1) * per_page)).mappings().all()
+    return rows, total
+
+
+def _catalogue_page(section, page, per_page, q=None):
+    model, actions = CATALOGUE_SECTIONS[section]
+    columns = [model.id, model.name] + ([model.available_quantity] if model is Equipment else [])
+    stmt = select(*columns).order_by(model.name)
+    if q:
+        stmt = stmt.where(model.name.icontains(q, autoescape=True))
+    rows, total = _page(stmt, page, per_page)
+    items = []
+    for r in rows:
+        item = dict(r)
+        item.update({key: url_for(endpoint, **{arg: r['id']}) for key, (endpoint, arg) in actions.items()})
+        items.append(item)
+    return items, total
+
+
+def _record_page(section, page, per_page, marathon_id=None, station_id=None, equipment_id=None, created_by=None):
+    stream, actions = RECORD_SECTIONS[section]
+    stmt = transaction_history_query([stream], marathon_id=marathon_id, station_id=station_id,
+                                     equipment_id=equipment_id, created_by=created_by)
+    rows, total = _page(stmt, page, per_page)
+    return [{
+        'id': r['id'],
+        'timestamp': r['timestamp'].strftime('%Y-%m-%d %H:%M') if r['timestamp'] else None,
+        'marathon': r['marathon'],
+        'station': r['station'],
+        'equipment': r['equipment'],
+        'quantity': r['quantity'],
+        'person': r['person'],
+        'created_by': r['created_by'],
+        **{key: url_for(endpoint, record_id=r['id']) for key, endpoint in actions.items()},
+    } for r in rows], total
+
+
+def dashboard_section(section, page=1, per_page=DASHBOARD_PAGE_SIZE, **filters):
+    """One page of an admin dashboard section as a JSON-ready dict.
+
+    Catalogue sections accept `q` (name contains); record sections accept
+    `marathon_id`, `station_id`, `equipment_id` and `created_by`. Each page costs
+    a count query and a page query with names joined in.
+    """
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), DASHBOARD_MAX_PAGE_SIZE)
+    if section in CATALOGUE_SECTIONS:
+        items, total = _catalogue_page(section, page, per_page, filters.get('q'))
+    else:
+        items, total = _record_page(section, page, per_page, filters.get('marathon_id'), filters.get('station_id'),
+                                    filters.get('equipment_id'), filters.get('created_by'))
+    return {'items': items, 'page': page, 'per_page': per_page, 'total': total,
+            'pages': max((total + per_page - 1) // per_page, 1)}
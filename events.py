@@ -0,0 +1,292 @@
+import json
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import event, insert, text
+from sqlalchemy.orm import Session
+from models import db, RecordEvent, Station, Equipment
+from balances import committed_value, bump_ledger_versions
+from history import ALL_STREAMS, records_by_id
+
+# Record changes are logged to RecordEvent in the writing transaction. On Postgres the
+# same transaction NOTIFYs CHANNEL with the marathon id and one LISTEN thread per process
+# wakes the open streams; on SQLite the streams poll the log by its monotonic id.
+CHANNEL = 'record_events'
+RELOAD = 'reload'  # event kind asking clients to reload the page instead of applying deltas
+EVENT_BATCH = 500  # log rows sent per SSE message
+RETRY_MS = 5000  # browser reconnect delay after a stream ends
+LISTEN_RETRY = 5  # seconds before the LISTEN thread reconnects after an error
+
+KIND_BY_MODEL = {model: kind for kind, model in ALL_STREAMS}
+MODEL_BY_KIND = dict(ALL_STREAMS)
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeNotifier:
+    """Lets the event streams of this process sleep until their marathon changes"""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = defaultdict(int)
+
+    def notify(self, marathon_ids):
+        with self._condition:
+            for marathon_id in marathon_ids:
+                self._versions[marathon_id] += 1
+            self._condition.notify_all()
+
+    def version(self, marathon_id):
+        with self._condition:
+            return self._versions[marathon_id]
+
+    def wait(self, marathon_id, seen, timeout):
+        """Block until the marathon's version differs from `seen` or `timeout` passes; return the version"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._versions[marathon_id] != seen, timeout)
+            return self._versions[marathon_id]
+
+
+notifier = ChangeNotifier()
+
+
+def _id(value):
+    # Form values arrive as strings, like in balances.balance_key
+    return int(value) if value not in (None, '') else None
+
+
+def _event_row(kind, record_id, value, sign, now):
+    """Log row for `sign` times a record's quantity, or None for records without a marathon"""
+    marathon_id = _id(value('marathon_id'))
+    if marathon_id is None:
+        return None
+    model = MODEL_BY_KIND[kind]
+    return {'marathon_id': marathon_id, 'kind': kind, 'record_id': record_id,
+            'station_id': _id(value('station_id')) if hasattr(model, 'station_id') else None,
+            'equipment_id': _id(value('equipment_id')), 'quantity': sign * int(value('quantity') or 0),
+            'created_at': now}
+
+
+def log_events(session, rows):
+    """Write event rows on the session's connection and announce their marathons.
+
+    Bumping the LedgerVersion first holds its row lock until commit, so events of one
+    marathon get their ids in commit order and a stream cursor never skips past an
+    event that commits later.
+    """
+    rows = [row for row in rows if row is not None]
+    if not rows:
+        return
+    connection = session.connection()
+    marathon_ids = {row['marathon_id'] for row in rows}
+    bump_ledger_versions(connection, marathon_ids)
+    connection.execute(insert(RecordEvent), rows)
+    if connection.dialect.name == 'postgresql':
+        # Delivered to listeners when (and only if) the transaction commits
+        for marathon_id in sorted(marathon_ids):
+            connection.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': CHANNEL, 'payload': str(marathon_id)})
+    session.info.setdefault('event_marathons', set()).update(marathon_ids)
+
+
+def log_inserted(session, model, ids, rows):
+    """Events for record rows inserted outside the ORM unit of work (ids in row order)"""
+    kind, now = KIND_BY_MODEL[model], datetime.utcnow()
+    log_events(session, [_event_row(kind, id, row.get, 1, now) for id, row in zip(ids, rows)])
+
+
+def log_reload(session, marathon_ids):
+    """One 'reload' event per marathon, for bulk writes not worth sending row by row"""
+    now = datetime.utcnow()
+    log_events(session, [{'marathon_id': m, 'kind': RELOAD, 'quantity': 0, 'created_at': now}
+                         for m in sorted(marathon_ids) if m])
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_record_changes(session, flush_context):
+    """Log every ORM insert, edit and delete of a record; runs inside the flush like balances.py"""
+    now = datetime.utcnow()
+    rows = []
+    for record in session.new:
+        kind = KIND_BY_MODEL.get(type(record))
+        if kind:
+            rows.append(_event_row(kind, record.id, lambda attr: getattr(record, attr), 1, now))
+    for record in session.deleted:
+        kind = KIND_BY_MODEL.get(type(record))
+        if kind:
+            rows.append(_event_row(kind, record.id, lambda attr: committed_value(record, attr), -1, now))
+    for record in session.dirty:
+        kind = KIND_BY_MODEL.get(type(record))
+        if kind and session.is_modified(record):
+            rows.append(_event_row(kind, record.id, lambda attr: committed_value(record, attr), -1, now))
+            rows.append(_event_row(kind, record.id, lambda attr: getattr(record, attr), 1, now))
+    log_events(session, rows)
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_local_streams(session):
+    # Streams of this process wake at once, without waiting for NOTIFY or their next poll
+    marathon_ids = session.info.pop('event_marathons', None)
+    if marathon_ids:
+        notifier.notify(marathon_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_events(session):
+    session.info.pop('event_marathons', None)
+
+
+def latest_event_id(marathon_id):
+    """Id of the marathon's last logged event, 0 before its first"""
+    return db.session.query(db.func.max(RecordEvent.id)).filter(RecordEvent.marathon_id == marathon_id).scalar() or 0
+
+
+def read_at_cursor(marathon_id, read, attempts=5):
+    """(read(), cursor) with the cursor of the last event already reflected in the result.
+
+    The cursor is read before and after `read`; if a write to the marathon landed in
+    between, the read is repeated. Returns a None cursor if writes never paused.
+    """
+    for _ in range(attempts):
+        before = latest_event_id(marathon_id)
+        result = read()
+        if latest_event_id(marathon_id) == before:
+            return result, before
+    return result, None
+
+
+def changes_since(marathon_id, cursor):
+    """(message dict or None, new cursor, more pending) for events of a marathon after `cursor`.
+
+    The message lists the current state of every record touched (or `deleted`),
+    and the summed quantity deltas per (type, station, equipment) for the totals.
+    """
+    events = db.session.query(RecordEvent, Station.name, Equipment.name
+        ).outerjoin(Station, Station.id == RecordEvent.station_id
+        ).outerjoin(Equipment, Equipment.id == RecordEvent.equipment_id
+        ).filter(RecordEvent.marathon_id == marathon_id, RecordEvent.id > cursor
+        ).order_by(RecordEvent.id).limit(EVENT_BATCH).all()
+    if not events:
+        return None, cursor, False
+    cursor, more = events[-1][0].id, len(events) == EVENT_BATCH
+    if any(e.kind == RELOAD for e, _, _ in events):
+        return {'reload': True}, cursor, more
+    deltas = {}
+    touched = defaultdict(set)
+    for e, station, equipment in events:
+        key = (e.kind, station, equipment)
+        deltas[key] = deltas.get(key, 0) + e.quantity
+        touched[e.kind].add(e.record_id)
+    records = []
+    for kind, ids in touched.items():
+        rows = records_by_id(kind, MODEL_BY_KIND[kind], ids, marathon_id)
+        for id in sorted(ids):
+            r = rows.get(id)
+            if r is None:  # deleted, or moved to another marathon
+                records.append({'type': kind, 'id': id, 'deleted': True})
+                continue
+            records.append({
+                'type': kind, 'id': id,
+                'timestamp': r['timestamp'].strftime('%Y-%m-%d %H:%M') if r['timestamp'] else None,
+                'station': r['station'], 'equipment': r['equipment'], 'quantity': r['quantity'],
+                'person': r['person'], 'created_by': r['created_by'],
+            })
+    message = {'records': records, 'deltas': [
+        {'type': kind, 'station': station, 'equipment': equipment, 'quantity': quantity}
+        for (kind, station, equipment), quantity in deltas.items() if quantity]}
+    return message, cursor, more
+
+
+def event_stream(marathon_id, cursor, poll_seconds, keepalive_seconds, max_seconds):
+    """Server-Sent Events for a marathon's record changes after event id `cursor`.
+
+    Ends after `max_seconds`; the browser then reconnects with Last-Event-ID. The
+    session is closed between checks so an idle stream holds no pooled connection.
+    """
+    listening = start_listener(db.engine)
+    deadline = time.monotonic() + max_seconds
+    last_sent = time.monotonic()
+    seen = notifier.version(marathon_id)
+    yield f'retry: {RETRY_MS}\n\n'
+    if cursor and db.session.get(RecordEvent, cursor) is None:
+        # The cursor's event was pruned, so later ones may be gone too: start from a fresh page
+        yield f'event: records\ndata: {json.dumps({"reload": True})}\n\n'
+        return
+    while True:
+        message, cursor, more = changes_since(marathon_id, cursor)
+        db.session.close()
+        if message:
+            yield f'id: {cursor}\nevent: records\ndata: {json.dumps(message, ensure_ascii=False)}\n\n'
+            last_sent = time.monotonic()
+        if more:
+            continue
+        if time.monotonic() >= deadline:
+            return
+        if time.monotonic() - last_sent >= keepalive_seconds:
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        # With LISTEN running the timeout is only a safety net; otherwise it is the poll interval
+        seen = notifier.wait(marathon_id, seen, keepalive_seconds if listening else poll_seconds)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start_listener(engine):
+    """Start this process's LISTEN thread once; False when the database has no LISTEN (SQLite)"""
+    global _listener
+    if engine.dialect.name != 'postgresql':
+        return False
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=_listen, args=(engine,), name='record-events-listener', daemon=True)
+            _listener.start()
+    return True
+
+
+def _received(payload):
+    try:
+        notifier.notify([int(payload)])
+    except ValueError:
+        pass
+
+
+def _listen(engine):
+    while True:
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            connection.detach()  # a dedicated connection, not one of the pool's slots
+            driver = connection.driver_connection
+            driver.rollback()
+            driver.autocommit = True
+            cursor = driver.cursor()
+            cursor.execute(f'LISTEN {CHANNEL}')
+            cursor.close()
+            if callable(getattr(driver, 'notifies', None)):  # psycopg 3
+                for notify in driver.notifies():
+                    _received(notify.payload)
+            else:  # psycopg2
+                while True:
+                    select.select([driver], [], [])
+                    driver.poll()
+                    while driver.notifies:
+                        _received(driver.notifies.pop(0).payload)
+        except Exception:
+            logger.exception("Record event listener failed, reconnecting in %ss", LISTEN_RETRY)
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+        time.sleep(LISTEN_RETRY)
+
+
+def prune_events(before):
+    """Delete events logged before `before`; returns the number deleted"""
+    count = RecordEvent.query.filter(RecordEvent.created_at < before).delete(synchronize_session=False)
+    db.session.commit()
+    return count
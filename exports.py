@@ -0,0 +1,153 @@
+import csv
+import io
+import re
+import zipfile
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+from models import db
+from history import transaction_history_query
+
+# Rows fetched per round trip from the server-side cursor and written per output chunk
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_COLUMNS = ['Loại', 'Thời gian', 'Giải chạy', 'Trạm', 'Tên', 'Số lượng', 'Người giao/trả', 'Người tạo']
+TYPE_LABELS = {'issue': 'Giao', 'return': 'Trả', 'store_issue': 'Xuất kho', 'store_return': 'Nhập kho'}
+
+
+def parse_time_bound(value, end=False):
+    """Parse a YYYY-MM-DD or ISO datetime filter; a bare `end` date includes that whole day"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def export_rows(streams, **filters):
+    """Yield transaction rows (lists of cell values) oldest first without loading them all.
+
+    The query runs with yield_per so the driver uses a server-side cursor where the
+    backend supports it, keeping memory flat regardless of history size. A closed
+    marathon's archived records are exported too.
+    """
+    stmt = transaction_history_query(streams, newest_first=False, archived=True, **filters)
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for r in result.mappings():
+        yield [
+            TYPE_LABELS.get(r['type'], r['type']),
+            r['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if r['timestamp'] else '',
+            r['marathon'] or '',
+            r['station'] or '',
+            r['equipment'] or '',
+            r['quantity'],
+            r['person'] or '',
+            r['created_by'] or '',
+        ]
+
+
+def _batched(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_csv(rows, columns=EXPORT_COLUMNS):
+    """Encode rows as UTF-8 CSV chunks; the BOM lets Excel detect Vietnamese text"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for batch in _batched(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _ChunkSink:
+    """Write-only, non-seekable file object collecting bytes for a streamed response"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Data" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+
+
+# Control characters are not allowed in XML text
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c><v>{value}</v></c>')
+        else:
+            text = escape(_XML_INVALID.sub('', str(value)))
+            cells.append(f'<c t="inlineStr"><is><t>{text}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def stream_xlsx(rows, columns=EXPORT_COLUMNS):
+    """Encode rows as a single-sheet XLSX workbook, yielding zip chunks as they are written.
+
+    Uses inline strings so no shared-string table has to be held in memory.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        yield sink.drain()
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                         + _xlsx_row(columns)).encode('utf-8'))
+            for batch in _batched(rows):
+                sheet.write(''.join(_xlsx_row(row) for row in batch).encode('utf-8'))
+                yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
@@ -0,0 +1,62 @@
+# Gunicorn settings for Render/Procfile deploys: `gunicorn -c gunicorn.conf.py app:app`.
+# Every value can be overridden with the environment variable next to it.
+import multiprocessing
+import os
+import shutil
+import tempfile
+from dotenv import load_dotenv
+
+load_dotenv()
+
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# Requests mostly wait on the database, so small instances get few processes with
+# several threads each instead of many memory-hungry sync workers.
+# SQLite allows a single writer, so it gets one process whose threads share the
+# in-process write queue (SQLITE_WRITE_QUEUE) instead of competing for the file lock.
+sqlite = os.getenv('DATABASE_URL', 'sqlite').startswith('sqlite')
+workers = int(os.getenv('WEB_CONCURRENCY', 1 if sqlite else min(cpus * 2 + 1, 9) if cpus > 1 else 2))
+# Live report streams (/api/marathons/<id>/events) each hold a thread; app.py caps them at
+# EVENTS_MAX_STREAMS per worker (default threads // 2, at least 1) and answers 503 beyond,
+# so raise WEB_THREADS or EVENTS_MAX_STREAMS when many report pages stay open at once.
+threads = int(os.getenv('WEB_THREADS', 8 if sqlite else 4 if cpus <= 2 else 2))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+accesslog = '-'
+
+# Seen by app.py when workers import it: size the pool to the thread count, and stop
+# runaway queries before gunicorn kills the worker (CLI commands keep no timeout).
+os.environ['WEB_THREADS'] = str(threads)
+os.environ.setdefault('DB_STATEMENT_TIMEOUT_MS', str((timeout - 5) * 1000))
+# Per-process metric files merged by /metrics (prometheus_client multiprocess mode)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'be-rao-metrics'))
+
+
+def on_starting(server):
+    # Samples from a previous run would be counted again
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    server.log.info("%s workers x %s threads (%s), %s CPUs; pool size %s + overflow %s per worker",
+                    workers, threads, worker_class, cpus,
+                    os.getenv('DB_POOL_SIZE', threads), os.getenv('DB_MAX_OVERFLOW', '2'))
+
+
+def worker_exit(server, worker):
+    """Log the worker's final pool counters, e.g. to spot connections left checked out"""
+    try:
+        from app import app, pool_stats
+        with app.app_context():
+            server.log.info("pool stats %s", pool_stats())
+    except Exception as e:
+        server.log.warning("pool stats unavailable: %s", e)
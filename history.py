@@ -0,0 +1,100 @@
+from sqlalchemy import select, union_all, literal_column, null
+from models import db, Station, Equipment, Marathon, IssueRecord, ReturnRecord, StoreIssueRecord, StoreReturnRecord, MarathonArchive, RECORD_ARCHIVES
+
+# (type tag shown in templates, record model) for each transaction stream
+STATION_STREAMS = (('issue', IssueRecord), ('return', ReturnRecord))
+STORE_STREAMS = (('store_issue', StoreIssueRecord), ('store_return', StoreReturnRecord))
+ALL_STREAMS = STORE_STREAMS[:1] + STATION_STREAMS + STORE_STREAMS[1:]
+
+
+def _stream_select(position, kind, model, marathon_id=None, limit=None, station_id=None, start=None, end=None,
+                   equipment_id=None, created_by=None, table=None):
+    """Select one record table (or its archive `table`) with station/equipment/marathon names joined in"""
+    t = model.__table__ if table is None else table
+    has_station = 'station_id' in t.c
+    stmt = select(
+        literal_column(f"'{kind}'").label('type'),
+        literal_column(str(position)).label('stream'),
+        t.c.id.label('id'),
+        t.c.timestamp.label('timestamp'),
+        (Station.name if has_station else null()).label('station'),
+        Equipment.name.label('equipment'),
+        Marathon.name.label('marathon'),
+        t.c.quantity.label('quantity'),
+        t.c.person_name.label('person'),
+        t.c.created_by.label('created_by'),
+    ).select_from(t).outerjoin(Equipment, Equipment.id == t.c.equipment_id
+    ).outerjoin(Marathon, Marathon.id == t.c.marathon_id)
+    if has_station:
+        stmt = stmt.outerjoin(Station, Station.id == t.c.station_id)
+    if marathon_id:
+        stmt = stmt.where(t.c.marathon_id == marathon_id)
+    if station_id:
+        stmt = stmt.where(t.c.station_id == station_id)
+    if equipment_id:
+        stmt = stmt.where(t.c.equipment_id == equipment_id)
+    if created_by:
+        stmt = stmt.where(t.c.created_by == created_by)
+    if start:
+        stmt = stmt.where(t.c.timestamp >= start)
+    if end:
+        stmt = stmt.where(t.c.timestamp < end)
+    if limit:
+        # Wrap so the per-stream LIMIT stays valid inside UNION ALL on SQLite
+        stmt = select(stmt.order_by(t.c.timestamp.desc().nullslast(), t.c.id).limit(limit).subquery())
+    return stmt
+
+
+def is_closed(marathon_id):
+    """True when the marathon was closed out and its records live in the archive tables"""
+    return str(marathon_id).isdigit() and db.session.get(MarathonArchive, int(marathon_id)) is not None
+
+
+def transaction_history_query(streams, marathon_id=None, limit=None, station_id=None, start=None, end=None, newest_first=True,
+                              equipment_id=None, created_by=None, archived=False):
+    """UNION ALL of the given record streams, newest first by default.
+
+    `limit` caps each stream; `start`/`end` bound the timestamp (end exclusive);
+    `equipment_id` and `created_by` (username) narrow the records further.
+    Filtering by station drops the store streams, which have no station.
+    With `archived`, a closed marathon's archived records are included too.
+    """
+    if station_id:
+        streams = [(kind, model) for kind, model in streams if hasattr(model, 'station_id')]
+    # (position, kind, model, table) per SELECT; an archive shares its stream's position
+    sources = [(position, kind, model, None) for position, (kind, model) in enumerate(streams)]
+    if archived and marathon_id and is_closed(marathon_id):
+        sources += [(position, kind, model, RECORD_ARCHIVES[model]) for position, kind, model, _ in sources]
+    merged = union_all(*[
+        _stream_select(position, kind, model, marathon_id, limit, station_id, start, end, equipment_id, created_by, table)
+        for position, kind, model, table in sources
+    ]).subquery()
+    timestamp = merged.c.timestamp.desc().nullslast() if newest_first else merged.c.timestamp.asc().nullsfirst()
+    return select(merged).order_by(timestamp, merged.c.stream, merged.c.id)
+
+
+def transaction_history(streams, marathon_id=None, limit=None):
+    """Merge record streams into one newest-first list of transaction dicts.
+
+    Names are resolved with joins and the merge is ordered by the database, so the
+    page costs a single query regardless of history size. Records of a closed
+    marathon are read from the archive tables as well.
+    """
+    rows = db.session.execute(transaction_history_query(streams, marathon_id, limit, archived=True)).mappings()
+    return [{
+        'type': r['type'],
+        'id': r['id'],
+        'timestamp': r['timestamp'],
+        'station': r['station'],
+        'equipment': r['equipment'],
+        'marathon': r['marathon'],
+        'quantity': r['quantity'],
+        'person': r['person'],
+        'created_by': r['created_by']
+    } for r in rows]
+
+
+def records_by_id(kind, model, ids, marathon_id=None):
+    """Current rows of one record stream with names joined in, keyed by record id"""
+    stmt = _stream_select(0, kind, model, marathon_id).where(model.id.in_(ids))
+    return {r['id']: r for r in db.session.execute(stmt).mappings()}
@@ -0,0 +1,260 @@
+import csv
+import io
+import json
+import time
+from sqlalchemy import insert
+from models import db, Marathon, Station, Equipment
+from balances import apply_balance_deltas, row_deltas
+from events import log_reload
+from records import RECORD_TYPES, name_key, resolve_names, int_field, parse_timestamp, note_inserted
+from refcache import REFERENCE_LISTS
+from exports import EXPORT_COLUMNS, TYPE_LABELS
+
+IMPORT_BATCH_SIZE = 5000
+
+# Headers written by exports.py, so an exported file can be imported again
+HEADER_ALIASES = dict(zip(EXPORT_COLUMNS, ('type', 'timestamp', 'marathon', 'station', 'equipment', 'quantity', 'person_name', 'created_by')))
+TYPE_BY_LABEL = {label: kind for kind, label in TYPE_LABELS.items()}
+
+# Entity referenced by each record column: (field, model)
+REFERENCES = (('marathon', Marathon), ('station', Station), ('equipment', Equipment))
+
+
+def read_items(path, fmt=None):
+    """Yield (line number, dict) for each row of a CSV or JSONL file, one row at a time.
+
+    Lines that are not valid JSON objects are yielded as (line, ValueError).
+    """
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.json', '.ndjson')) else 'csv')
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for item in reader:
+                yield reader.line_num, {HEADER_ALIASES.get(k.strip(), k.strip()): v for k, v in item.items() if k}
+            return
+        for line, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+            try:
+                item = json.loads(text)
+                if not isinstance(item, dict):
+                    raise ValueError('row must be an object')
+            except ValueError as e:
+                yield line, ValueError(f'invalid JSON: {e}')
+                continue
+            yield line, item
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _text(item, field):
+    value = item.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f'invalid {field}')
+    return value.strip() or None
+
+
+class NameMap:
+    """In-memory name -> id map of one reference table, loaded with a single query"""
+    def __init__(self, model):
+        self.model = model
+        self.key = name_key(model)
+        self.ids = {}
+        self.folded = {}
+        self.id_set = set()
+        for id, name in db.session.query(model.id, model.name):
+            self._add(name, id)
+
+    def _add(self, name, id):
+        self.ids[name] = id
+        self.folded.setdefault(self.key(name), id)
+        self.id_set.add(id)
+
+    def get(self, name):
+        """Id for `name`, matching on the normalized name when there is no exact match"""
+        return self.ids.get(name) or self.folded.get(self.key(name))
+
+    def create(self, names):
+        """Create rows for names not in the map (one flush) and add them"""
+        missing = {n for n in names if self.get(n) is None}
+        for name, id in resolve_names(self.model, missing).items():
+            self._add(name, id)
+
+    def known_id(self, id):
+        return id in self.id_set
+
+
+def _reference_id(item, field, names, required=False):
+    """Id for `field` given either as `<field>_id` or as a name in `<field>`"""
+    if item.get(f'{field}_id') not in (None, ''):
+        id = int_field(item, f'{field}_id')
+        if not names.known_id(id):
+            raise ValueError(f'unknown {field}_id {id}')
+        return id
+    name = _text(item, field)
+    if name is None:
+        if required:
+            raise ValueError(f'missing {field}')
+        return None
+    id = names.get(name)
+    if id is None:
+        raise ValueError(f'unknown {field} "{name}"')
+    return id
+
+
+def _record_row(item, default_type, maps, created_by):
+    """(model, row dict) for one import row; ValueError describes why it is rejected"""
+    kind = _text(item, 'type') or default_type
+    model = RECORD_TYPES.get(TYPE_BY_LABEL.get(kind, kind))
+    if model is None:
+        raise ValueError('invalid type')
+    quantity = int_field(item, 'quantity', required=True)
+    if quantity <= 0:
+        raise ValueError('quantity must be positive')
+    row = {
+        'marathon_id': _reference_id(item, 'marathon', maps['marathon']),
+        'equipment_id': _reference_id(item, 'equipment', maps['equipment'], required=True),
+        'person_name': _text(item, 'person_name'),
+        'quantity': quantity,
+        'timestamp': parse_timestamp(_text(item, 'timestamp')),
+        'created_by': _text(item, 'created_by') or created_by,
+    }
+    if hasattr(model, 'station_id'):
+        row['station_id'] = _reference_id(item, 'station', maps['station'])
+    elif item.get('station') or item.get('station_id'):
+        raise ValueError('station not allowed for store records')
+    return model, row
+
+
+def copy_rows(model, rows):
+    """Write record rows in one round trip: COPY on Postgres, executemany elsewhere.
+
+    Runs on the session's connection, so the rows commit with the session.
+    """
+    note_inserted(model, len(rows))
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        connection.execute(insert(model.__table__), rows)
+        return
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    # In CSV format COPY reads an unquoted empty field as NULL
+    csv.writer(buffer).writerows([['' if row[c] is None else row[c] for c in columns] for row in rows])
+    buffer.seek(0)
+    sql = f'COPY {model.__table__.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)'
+    cursor = connection.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(sql, buffer)  # psycopg2
+        else:
+            with cursor.copy(sql) as copy:  # psycopg 3
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def _merge_deltas(total, deltas):
+    for key, flows in deltas.items():
+        row = total.setdefault(key, dict.fromkeys(flows, 0))
+        for flow, quantity in flows.items():
+            row[flow] += quantity
+
+
+def import_records(items, default_type=None, created_by='import', create_missing=False, batch_size=IMPORT_BATCH_SIZE, report=print):
+    """Import issue/return/store record rows from (line, item) pairs in batches.
+
+    Names are resolved against in-memory maps loaded once; with `create_missing`,
+    unknown marathons/stations/equipment are created per batch. Balance deltas are
+    summed over the whole import and applied once at the end. Everything runs in
+    the caller's transaction; the caller commits.
+    Returns (imported count, rejected list of (line, error, item)).
+    """
+    maps = {field: NameMap(model) for field, model in REFERENCES}
+    rejected = []
+    deltas = {}
+    imported = 0
+    for number, batch in enumerate(_batches(items, batch_size), 1):
+        started = time.perf_counter()
+        if create_missing:
+            for field, _ in REFERENCES:
+                names = set()
+                for _, item in batch:
+                    if isinstance(item, dict) and isinstance(item.get(field), str) and item[field].strip():
+                        names.add(item[field].strip())
+                maps[field].create(names)
+        rows_by_model = {}
+        batch_rejected = 0
+        for line, item in batch:
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                model, row = _record_row(item, default_type, maps, created_by)
+            except ValueError as e:
+                rejected.append((line, str(e), item if isinstance(item, dict) else None))
+                batch_rejected += 1
+                continue
+            rows_by_model.setdefault(model, []).append(row)
+        for model, rows in rows_by_model.items():
+            copy_rows(model, rows)
+            _merge_deltas(deltas, row_deltas(model, rows))
+        written = len(batch) - batch_rejected
+        imported += written
+        elapsed = time.perf_counter() - started
+        report(f"batch {number}: {written} rows in {elapsed:.2f}s ({written / elapsed if elapsed else 0:.0f} rows/s), {batch_rejected} rejected")
+    apply_balance_deltas(db.session.connection(), deltas)
+    # Open report pages reload once rather than receive every imported row
+    log_reload(db.session, {key[0] for key in deltas})
+    return imported, rejected
+
+
+def import_references(kind, items, batch_size=IMPORT_BATCH_SIZE, report=print):
+    """Create marathons/stations/equipments/persons from rows with a `name` column.
+
+    Existing names are skipped. Rows go through the ORM (one flush per batch) so
+    reference versions and cached lists stay correct. The caller commits.
+    Returns (created count, rejected list of (line, error, item)).
+    """
+    model, _ = REFERENCE_LISTS[kind]
+    key = name_key(model)
+    known = {key(name) for (name,) in db.session.query(model.name)}
+    rejected = []
+    created = 0
+    for number, batch in enumerate(_batches(items, batch_size), 1):
+        started = time.perf_counter()
+        new = []
+        batch_rejected = 0
+        for line, item in batch:
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                name = _text(item, 'name')
+                if name is None:
+                    raise ValueError('missing name')
+                if key(name) in known:
+                    continue
+                obj = model(name=name)
+                if model is Equipment:
+                    obj.available_quantity = int_field(item, 'available_quantity') or 0
+            except ValueError as e:
+                rejected.append((line, str(e), item if isinstance(item, dict) else None))
+                batch_rejected += 1
+                continue
+            known.add(key(name))
+            new.append(obj)
+        db.session.add_all(new)
+        db.session.flush()
+        created += len(new)
+        elapsed = time.perf_counter() - started
+        report(f"batch {number}: {len(new)} created, {len(batch) - len(new) - batch_rejected} existing in {elapsed:.2f}s, {batch_rejected} rejected")
+    return created, rejected
@@ -0,0 +1,48 @@
+from sqlalchemy import select
+from models import db, IssueRecord, ReturnRecord, Person, RecordEvent
+from history import transaction_history_query, STATION_STREAMS, STORE_STREAMS
+from balances import ledger_query
+from aggregation import marathon_balances
+
+
+def hot_queries(marathon_id):
+    """(name, statement) for the queries run by the busiest pages"""
+    return [
+        ('report: issue/return history', transaction_history_query(STATION_STREAMS, marathon_id=marathon_id)),
+        ('reconciliation: store history', transaction_history_query(STORE_STREAMS, marathon_id=marathon_id)),
+        ('reconciliation: latest store records', transaction_history_query(STORE_STREAMS, limit=100)),
+        ('admin_dashboard: issue records page', transaction_history_query([('issue', IssueRecord)]).limit(50)),
+        ('admin_dashboard: return records page', transaction_history_query([('return', ReturnRecord)]).limit(50)),
+        ('admin_dashboard: marathon issue records page', transaction_history_query([('issue', IssueRecord)], marathon_id=marathon_id).limit(50)),
+        ('balances: marathon rows and close-out summary', select(marathon_balances(marathon_id))),
+        ('rebuild: marathon ledger', ledger_query(marathon_id)),
+        ('events: marathon changes after cursor', select(RecordEvent).where(RecordEvent.marathon_id == marathon_id, RecordEvent.id > 0)
+         .order_by(RecordEvent.id).limit(500)),
+        ('search: person name prefix', select(Person.id, Person.name).where(Person.lookup >= 'ng', Person.lookup < 'ng\U0010ffff')
+         .order_by(Person.lookup).limit(20)),
+    ]
+
+
+def explain(statement):
+    """Return the query plan lines for a statement on the current database"""
+    dialect = db.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN ' if dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN '
+    rows = db.session.connection().exec_driver_sql(prefix + sql).fetchall()
+    # SQLite returns (id, parent, notused, detail); Postgres returns one text column
+    return [row[-1] for row in rows]
+
+
+def sequential_scans(plan):
+    """Plan lines that read a whole table instead of using an index"""
+    if db.engine.dialect.name == 'postgresql':
+        return [line.strip() for line in plan if 'Seq Scan' in line]
+    # SQLite reports "SCAN <table>" for a full table scan; subquery scans are named anon_N
+    return [line for line in plan if line.startswith('SCAN ') and ' USING ' not in line
+            and line.split()[1] in db.metadata.tables]
+
+
+def check_indexes(marathon_id):
+    """EXPLAIN every hot query and return [(name, plan, sequential scans)]"""
+    return [(name, plan, sequential_scans(plan)) for name, plan in
+            ((name, explain(stmt)) for name, stmt in hot_queries(marathon_id))]
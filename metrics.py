@@ -0,0 +1,60 @@
+import os
+import time
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import multiprocess
+
+# With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every worker writes its samples
+# to files in that directory and /metrics merges them, whichever worker serves the scrape.
+REQUESTS = Counter('berao_http_requests_total', 'HTTP requests by endpoint and status', ['endpoint', 'method', 'status'])
+LATENCY = Histogram('berao_http_request_duration_seconds', 'HTTP request latency by endpoint', ['endpoint'])
+RECORDS = Counter('berao_records_inserted_total', 'Committed issue/return/store records by type', ['type'])
+POOL_CHECKED_OUT = Gauge('berao_db_pool_checked_out', 'Database connections in use', multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('berao_db_pool_overflow', 'Connections open beyond the pool size', multiprocess_mode='livesum')
+POOL_SIZE = Gauge('berao_db_pool_size', 'Configured pool size', multiprocess_mode='livesum')
+
+
+@event.listens_for(Session, 'after_commit')
+def _count_committed_records(session):
+    for kind, count in session.info.pop('inserted_records', {}).items():
+        RECORDS.labels(kind).inc(count)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back_records(session):
+    session.info.pop('inserted_records', None)
+
+
+def render_metrics():
+    """Prometheus text exposition of this process, or of all workers in multiprocess mode"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def install_metrics(app, pool_stats):
+    """Record count, latency and status of every request, and the pool gauges after it"""
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        # Unmatched URLs share one label so random paths cannot grow the series count
+        endpoint = request.endpoint or 'unmatched'
+        LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+        REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+        stats = pool_stats()
+        if 'checkedout' in stats:
+            POOL_CHECKED_OUT.set(stats['checkedout'])
+            POOL_OVERFLOW.set(max(stats['overflow'], 0))
+            POOL_SIZE.set(stats['size'])
+        return response
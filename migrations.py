@@ -0,0 +1,163 @@
+from datetime import datetime
+from sqlalchemy import bindparam, inspect, select, text
+from models import db, SchemaVersion, ReferenceVersion, StockBalance, RecordEvent, IdempotencyKey, MarathonSummary, MarathonArchive, RECORD_ARCHIVES, User, Marathon, Person, Station, Equipment, IssueRecord, ReturnRecord, StoreIssueRecord, StoreReturnRecord
+from names import normalize_name
+
+# Migrations run once per database, in version order, by `flask migrate` at deploy time.
+# A fresh database is created from the models directly and stamped with the latest version,
+# so each migration only has to bring the schema of the previous version up to date.
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+@migration(1, 'baseline: columns and indexes added before versioned migrations')
+def _baseline():
+    """Bring a database created by any earlier release up to the first versioned schema"""
+    db.create_all()
+    inspector = inspect(db.engine)
+    columns = {table: {c['name'] for c in inspector.get_columns(table)} for table in inspector.get_table_names()}
+    sqlite = db.engine.dialect.name == 'sqlite'
+    added = [
+        ('issue_record', 'created_by', 'TEXT' if sqlite else 'VARCHAR(100)'),
+        ('return_record', 'created_by', 'TEXT' if sqlite else 'VARCHAR(100)'),
+        ('store_issue_record', 'person_name', 'TEXT' if sqlite else 'VARCHAR(200)'),
+        ('store_return_record', 'person_name', 'TEXT' if sqlite else 'VARCHAR(200)'),
+        ('equipment', 'available_quantity', 'INTEGER DEFAULT 0'),
+        ('marathon', 'version', 'INTEGER DEFAULT 0'),
+        ('station', 'version', 'INTEGER DEFAULT 0'),
+        ('equipment', 'version', 'INTEGER DEFAULT 0'),
+        ('person', 'version', 'INTEGER DEFAULT 0'),
+    ]
+    for table, column, ddl in added:
+        if column not in columns[table]:
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            columns[table].add(column)
+    db.session.commit()
+    # create_all() skips existing tables, so add indexes introduced after they were created;
+    # indexes on columns that later migrations add are left to those migrations
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if all(c.name in columns[table.name] for c in index.columns):
+                index.create(db.engine, checkfirst=True)
+    # Populate the balance table the first time it is created on a database with history
+    if StockBalance.query.first() is None and any(m.query.first() for m in (IssueRecord, ReturnRecord, StoreIssueRecord, StoreReturnRecord)):
+        from balances import rebuild_balances
+        rebuild_balances()
+
+
+def _add_lookup(*models):
+    """Add and backfill the unique `lookup` column (names.normalize_name of the name).
+
+    Names that only differed by case, accents or spacing collide on the new key; the
+    later rows keep their name and get `#<id>` appended to their key so nothing is
+    merged or lost. They are listed so an admin can merge them by hand.
+    """
+    inspector = inspect(db.engine)
+    for model in models:
+        table = model.__table__
+        if 'lookup' not in {c['name'] for c in inspector.get_columns(table.name)}:
+            ddl = table.c.lookup.type.compile(dialect=db.engine.dialect)
+            db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN lookup {ddl}"))
+        seen = set()
+        updates = []
+        for id, name in db.session.execute(select(table.c.id, table.c.name).order_by(table.c.id)):
+            key = normalize_name(name)
+            if key in seen:
+                print(f"  {table.name} {id} '{name}' has the same lookup name as an earlier row; stored as '{key}#{id}'")
+                key = f'{key}#{id}'
+            seen.add(key)
+            updates.append({'row_id': id, 'key': key})
+        if updates:
+            db.session.execute(table.update().where(table.c.id == bindparam('row_id')).values(lookup=bindparam('key')),
+                               updates)
+        db.session.commit()
+        for index in table.indexes:
+            if 'lookup' in index.columns:
+                index.create(db.engine, checkfirst=True)
+
+
+@migration(2, 'normalized name lookup on persons, equipment and stations')
+def _name_lookup():
+    _add_lookup(Person, Equipment, Station)
+
+
+@migration(3, 'record event log for live report updates')
+def _record_events():
+    RecordEvent.__table__.create(db.engine, checkfirst=True)
+
+
+@migration(4, 'marathon close-out summaries and record archive tables')
+def _closeout():
+    for table in (MarathonSummary.__table__, MarathonArchive.__table__, *RECORD_ARCHIVES.values()):
+        table.create(db.engine, checkfirst=True)
+
+
+@migration(5, 'normalized name lookup on marathons')
+def _marathon_lookup():
+    _add_lookup(Marathon)
+
+
+@migration(6, 'idempotency keys unique per user')
+def _user_idempotency_keys():
+    """Recreate the key table keyed by (user_id, key).
+
+    Stored keys do not say which user sent them, so they are dropped; only an upload
+    retried across the deploy can be ingested twice.
+    """
+    IdempotencyKey.__table__.drop(db.engine, checkfirst=True)
+    IdempotencyKey.__table__.create(db.engine)
+
+
+def current_version():
+    """Highest applied migration, or None for a database never migrated"""
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return None
+    return db.session.query(db.func.max(SchemaVersion.version)).scalar() or 0
+
+
+def _stamp(version, name):
+    db.session.add(SchemaVersion(version=version, name=name, applied_at=datetime.utcnow()))
+    db.session.commit()
+
+
+def _seed():
+    """Rows the app expects to exist: the reference version counter and the admin user"""
+    if db.session.get(ReferenceVersion, 1) is None:
+        db.session.add(ReferenceVersion(id=1, version=0))
+    if not User.query.filter_by(username='admin').first():
+        admin = User(username='admin', role='admin')
+        admin.set_password('admin123')
+        db.session.add(admin)
+    db.session.commit()
+
+
+def migrate(report=print):
+    """Apply pending migrations and seed rows; returns the resulting schema version"""
+    version = current_version()
+    latest = MIGRATIONS[-1][0]
+    if version is None and not inspect(db.engine).has_table(User.__tablename__):
+        # Empty database: create the current schema directly
+        db.create_all()
+        for number, name, _ in MIGRATIONS:
+            _stamp(number, name)
+        report(f"Created schema at version {latest}")
+    else:
+        if version is None:
+            # Database from before versioned migrations; the baseline is safe to rerun
+            SchemaVersion.__table__.create(db.engine, checkfirst=True)
+            version = 0
+        for number, name, fn in MIGRATIONS:
+            if number <= version:
+                continue
+            report(f"Applying {number}: {name}")
+            fn()
+            _stamp(number, name)
+    _seed()
+    return latest
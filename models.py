@@ -1,8 +1,27 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
+from names import normalize_name
 
 db = SQLAlchemy()
 
+# Byte-wise collation on Postgres so `lookup` prefix ranges can use the index
+LOOKUP_TYPE = db.String(200).with_variant(postgresql.VARCHAR(200, collation='C'), 'postgresql')
+
+
+class NameLookupMixin:
+    """Unique normalized copy of `name` (see names.normalize_name), kept in step on assignment.
+
+    Used for duplicate detection and indexed prefix search.
+    """
+    lookup = db.Column(LOOKUP_TYPE, unique=True, index=True)
+
+    @validates('name')
+    def _set_lookup(self, key, value):
+        self.lookup = normalize_name(value)
+        return value
+
 # Association table for User-Marathon many-to-many relationship
 user_marathon = db.Table('user_marathon',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
@@ -22,22 +41,26 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-class Marathon(db.Model):
+class Marathon(NameLookupMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True, nullable=False)
+    version = db.Column(db.Integer, default=0, index=True)  # ReferenceVersion at last change
 
-class Station(db.Model):
+class Station(NameLookupMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True, nullable=False)
+    version = db.Column(db.Integer, default=0, index=True)  # ReferenceVersion at last change
 
-class Equipment(db.Model):
+class Equipment(NameLookupMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True, nullable=False)
     available_quantity = db.Column(db.Integer, default=0)  # Tồn kho - available inventory
+    version = db.Column(db.Integer, default=0, index=True)  # ReferenceVersion at last change
 
-class Person(db.Model):
+class Person(NameLookupMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), unique=True, nullable=False)
+    version = db.Column(db.Integer, default=0, index=True)  # ReferenceVersion at last change
 
 class IssueRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,6 +72,12 @@ class IssueRecord(db.Model):
     timestamp = db.Column(db.DateTime)
     created_by = db.Column(db.String(100))  # Username of creator
 
+    __table_args__ = (
+        db.Index('ix_issue_record_marathon_equipment_station', 'marathon_id', 'equipment_id', 'station_id'),
+        db.Index('ix_issue_record_marathon_timestamp', 'marathon_id', 'timestamp'),
+        db.Index('ix_issue_record_timestamp', 'timestamp'),
+    )
+
 class ReturnRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     marathon_id = db.Column(db.Integer, db.ForeignKey('marathon.id'), nullable=True)
@@ -59,6 +88,12 @@ class ReturnRecord(db.Model):
     timestamp = db.Column(db.DateTime)
     created_by = db.Column(db.String(100))  # Username of creator
 
+    __table_args__ = (
+        db.Index('ix_return_record_marathon_equipment_station', 'marathon_id', 'equipment_id', 'station_id'),
+        db.Index('ix_return_record_marathon_timestamp', 'marathon_id', 'timestamp'),
+        db.Index('ix_return_record_timestamp', 'timestamp'),
+    )
+
 class StoreIssueRecord(db.Model):
     """Xuất kho - Store issues equipment to be dispatched"""
     id = db.Column(db.Integer, primary_key=True)
@@ -69,6 +104,12 @@ class StoreIssueRecord(db.Model):
     timestamp = db.Column(db.DateTime)
     created_by = db.Column(db.String(100))  # Username of storekeeper
 
+    __table_args__ = (
+        db.Index('ix_store_issue_record_marathon_equipment', 'marathon_id', 'equipment_id'),
+        db.Index('ix_store_issue_record_marathon_timestamp', 'marathon_id', 'timestamp'),
+        db.Index('ix_store_issue_record_timestamp', 'timestamp'),
+    )
+
 class StoreReturnRecord(db.Model):
     """Nhập kho - Equipment returned back to store"""
     id = db.Column(db.Integer, primary_key=True)
@@ -79,67 +120,112 @@ class StoreReturnRecord(db.Model):
     timestamp = db.Column(db.DateTime)
     created_by = db.Column(db.String(100))  # Username of storekeeper
 
+    __table_args__ = (
+        db.Index('ix_store_return_record_marathon_equipment', 'marathon_id', 'equipment_id'),
+        db.Index('ix_store_return_record_marathon_timestamp', 'marathon_id', 'timestamp'),
+        db.Index('ix_store_return_record_timestamp', 'timestamp'),
+    )
 
-def init_db():
-    db.create_all()
-    # Ensure older databases get new columns added without manual migrations.
-    try:
-        engine_url = str(db.engine.url)
-    except Exception:
-        engine_url = ''
-    
-    from sqlalchemy import text, inspect
-    
-    def _has_column(table, colname):
-        """Check if a column exists in a table (works for both SQLite and PostgreSQL)"""
-        inspector = inspect(db.engine)
-        columns = [col['name'] for col in inspector.get_columns(table)]
-        return colname in columns
-    
-    try:
-        # Add `created_by` to issue_record if missing
-        if not _has_column('issue_record', 'created_by'):
-            if 'sqlite' in engine_url:
-                db.session.execute(text("ALTER TABLE issue_record ADD COLUMN created_by TEXT"))
-            else:
-                db.session.execute(text("ALTER TABLE issue_record ADD COLUMN created_by VARCHAR(100)"))
-        
-        # Add `created_by` to return_record if missing
-        if not _has_column('return_record', 'created_by'):
-            if 'sqlite' in engine_url:
-                db.session.execute(text("ALTER TABLE return_record ADD COLUMN created_by TEXT"))
-            else:
-                db.session.execute(text("ALTER TABLE return_record ADD COLUMN created_by VARCHAR(100)"))
-        
-        # Add `person_name` to store_issue_record if missing
-        if not _has_column('store_issue_record', 'person_name'):
-            if 'sqlite' in engine_url:
-                db.session.execute(text("ALTER TABLE store_issue_record ADD COLUMN person_name TEXT"))
-            else:
-                db.session.execute(text("ALTER TABLE store_issue_record ADD COLUMN person_name VARCHAR(200)"))
-        
-        # Add `person_name` to store_return_record if missing
-        if not _has_column('store_return_record', 'person_name'):
-            if 'sqlite' in engine_url:
-                db.session.execute(text("ALTER TABLE store_return_record ADD COLUMN person_name TEXT"))
-            else:
-                db.session.execute(text("ALTER TABLE store_return_record ADD COLUMN person_name VARCHAR(200)"))
-        
-        # Add `available_quantity` to equipment if missing
-        if not _has_column('equipment', 'available_quantity'):
-            if 'sqlite' in engine_url:
-                db.session.execute(text("ALTER TABLE equipment ADD COLUMN available_quantity INTEGER DEFAULT 0"))
-            else:
-                db.session.execute(text("ALTER TABLE equipment ADD COLUMN available_quantity INTEGER DEFAULT 0"))
-        
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"Migration warning: {e}")
-    # Create default admin user if not exists
-    admin = User.query.filter_by(username='admin').first()
-    if not admin:
-        admin = User(username='admin', role='admin')
-        admin.set_password('admin123')
-        db.session.add(admin)
-        db.session.commit()
+class StockBalance(db.Model):
+    """Running totals per (marathon, station, equipment), maintained by balances.py.
+
+    Records without a marathon or station are stored under id 0 so the key can be
+    the primary key and be upserted atomically.
+    """
+    marathon_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    station_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    equipment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    store_issued = db.Column(db.Integer, nullable=False, default=0)  # Xuất kho
+    issued = db.Column(db.Integer, nullable=False, default=0)  # Đã giao
+    returned = db.Column(db.Integer, nullable=False, default=0)  # Đã trả
+    store_returned = db.Column(db.Integer, nullable=False, default=0)  # Nhập kho
+
+class MarathonSummary(db.Model):
+    """Final StockBalance rows of a closed marathon, frozen by closeout.py.
+
+    Reports add them to the marathon's StockBalance rows, which from then on only
+    hold records written after the close-out.
+    """
+    marathon_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    station_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    equipment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    store_issued = db.Column(db.Integer, nullable=False, default=0)
+    issued = db.Column(db.Integer, nullable=False, default=0)
+    returned = db.Column(db.Integer, nullable=False, default=0)
+    store_returned = db.Column(db.Integer, nullable=False, default=0)
+
+class MarathonArchive(db.Model):
+    """A closed marathon whose records were moved to the *_archive tables by closeout.py"""
+    marathon_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    closed_at = db.Column(db.DateTime)
+    closed_by = db.Column(db.String(100))
+    records = db.Column(db.Integer, nullable=False, default=0)  # rows in the archive tables
+
+def _archive_table(model):
+    """Copy of a record table without foreign keys; `id` keeps the original record id"""
+    name = f'{model.__tablename__}_archive'
+    return db.Table(name,
+        db.Column('archive_id', db.Integer, primary_key=True),
+        *[db.Column(c.name, c.type) for c in model.__table__.columns],
+        db.Index(f'ix_{name}_marathon_id', 'marathon_id'),
+    )
+
+# Record model -> archive table holding the records of closed marathons
+RECORD_ARCHIVES = {model: _archive_table(model) for model in (IssueRecord, ReturnRecord, StoreIssueRecord, StoreReturnRecord)}
+
+class LedgerVersion(db.Model):
+    """Per-marathon counter bumped by balances.py whenever that marathon's balances change.
+
+    Used as the ETag of the live unreturned-equipment endpoint.
+    """
+    marathon_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class ReferenceVersion(db.Model):
+    """Single-row generation counter for stations, equipment, persons and marathons.
+
+    Bumped by refcache.py whenever reference data changes so every worker process
+    knows when its cached lists are stale.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class RecordEvent(db.Model):
+    """One signed quantity change of a record, streamed to open report pages by events.py.
+
+    An insert logs +quantity, a delete -quantity and an edit both (old key, new key).
+    Bulk imports log a single 'reload' event per marathon instead of one per row.
+    """
+    id = db.Column(db.Integer, primary_key=True)  # stream cursor, sent as the SSE event id
+    marathon_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # record type ('issue', ...) or 'reload'
+    record_id = db.Column(db.Integer)
+    station_id = db.Column(db.Integer)
+    equipment_id = db.Column(db.Integer)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, index=True)
+
+    __table_args__ = (
+        db.Index('ix_record_event_marathon_id', 'marathon_id', 'id'),
+        {'sqlite_autoincrement': True},  # never reuse ids of pruned events: they are client cursors
+    )
+
+class IdempotencyKey(db.Model):
+    """Client-supplied key of a record already ingested through /api/records/batch, unique per user"""
+    user_id = db.Column(db.Integer, primary_key=True)  # no foreign key: keys of deleted users just age out
+    key = db.Column(db.String(100), primary_key=True)
+    created_at = db.Column(db.DateTime, index=True)
+
+class DeletedReference(db.Model):
+    """Tombstone for a deleted station/equipment/person/marathon, used by delta sync"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'marathons', 'stations', 'equipments' or 'persons'
+    ref_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, index=True)
+
+
+class SchemaVersion(db.Model):
+    """One row per migration applied by migrations.py"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime)
@@ -0,0 +1,17 @@
+import re
+import unicodedata
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_name(name):
+    """Lookup key for a name: Vietnamese diacritics removed, casefolded, spaces collapsed.
+
+    "  Nguyễn  Văn Đức " and "nguyen van duc" share the key "nguyen van duc".
+    """
+    if name is None:
+        return None
+    # đ is a separate letter, not d plus a combining mark, so NFKD leaves it alone
+    text = unicodedata.normalize('NFKD', name.replace('đ', 'd').replace('Đ', 'D'))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return _SPACES.sub(' ', text).strip().casefold()
@@ -0,0 +1,130 @@
+import cProfile
+import json
+import os
+import pstats
+import re
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+from flask import g, request, session
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+PROFILE_PARAM = '_profile'
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_MAX_AGE = 3600  # seconds a profiling token stays valid
+PROFILE_KEEP = 50  # profiles kept in instance/profiles/, oldest are deleted
+PROFILE_TOP = 15  # functions stored in each summary, by cumulative time
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.secret_key, salt='request-profile')
+
+
+def profile_token(app, user_id):
+    """Signed token that turns on profiling for requests of this (admin) user"""
+    return _serializer(app).dumps(user_id)
+
+
+def profiles_dir(app):
+    return os.path.join(app.instance_path, 'profiles')
+
+
+def _function_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name  # built-in
+    if 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep, 1)[1]
+    else:
+        filename = os.path.basename(filename)
+    return f'{filename}:{line}({name})'
+
+
+def _save(app, profiler, elapsed, status):
+    directory = profiles_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_')[:60] or 'index'
+    name = f'{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{slug}'
+    profiler.dump_stats(os.path.join(directory, name + '.prof'))
+    stats = pstats.Stats(profiler).sort_stats('cumulative')
+    top = []
+    for func in stats.fcn_list[:PROFILE_TOP]:
+        primitive_calls, calls, own_time, cumulative, _ = stats.stats[func]
+        top.append({'function': _function_name(func), 'calls': calls,
+                    'own_ms': round(own_time * 1000, 2), 'cumulative_ms': round(cumulative * 1000, 2)})
+    query = urlencode([(k, v) for k, v in request.args.items(multi=True) if k != PROFILE_PARAM])
+    summary = {
+        'name': name,
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'method': request.method,
+        'path': request.path + (f'?{query}' if query else ''),
+        'status': status,
+        'duration_ms': round(elapsed * 1000, 1),
+        'top': top,
+    }
+    with open(os.path.join(directory, name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False)
+    # Keep only the most recent profiles
+    for old in sorted(n for n in os.listdir(directory) if n.endswith('.json'))[:-PROFILE_KEEP]:
+        for ext in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, old[:-5] + ext))
+            except FileNotFoundError:
+                pass
+
+
+def recent_profiles(app, limit=10):
+    """Summaries of the newest stored profiles, newest first"""
+    directory = profiles_dir(app)
+    if not os.path.isdir(directory):
+        return []
+    summaries = []
+    for name in sorted((n for n in os.listdir(directory) if n.endswith('.json')), reverse=True)[:limit]:
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return summaries
+
+
+def install_profiling(app, is_admin):
+    """Run a request under cProfile when it carries a valid token from profile_token().
+
+    The token goes in the `_profile` query parameter or the X-Profile header, must
+    belong to the logged-in user and that user must still be an admin (`is_admin`).
+    Requests without a token only pay for the parameter/header lookup.
+    """
+    @app.before_request
+    def _start_profile():
+        token = request.args.get(PROFILE_PARAM) or request.headers.get(PROFILE_HEADER)
+        if not token:
+            return
+        try:
+            user_id = _serializer(app).loads(token, max_age=PROFILE_TOKEN_MAX_AGE)
+        except BadSignature:
+            return
+        if user_id != session.get('user_id') or not is_admin():
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return  # another request of this process is already being profiled
+        g.profiler = profiler
+        g.profile_start = time.perf_counter()
+
+    @app.after_request
+    def _stop_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            _save(app, profiler, time.perf_counter() - g.profile_start, response.status_code)
+        return response
+
+    @app.teardown_request
+    def _discard_profile(exc):
+        # after_request is skipped when the view raised; never leave the profiler running
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
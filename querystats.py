@@ -0,0 +1,70 @@
+import re
+import time
+from collections import Counter
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _stats():
+    """Counters of the current request, or None outside requests (CLI, startup)"""
+    if not has_request_context():
+        return None
+    return g.get('query_stats')
+
+
+def install_query_stats(app, engine):
+    """Count and time SQL statements and template rendering per request.
+
+    Adds a Server-Timing header (db, db-count, render, total) when SERVER_TIMING is
+    on, and logs requests above QUERY_LOG_COUNT statements or QUERY_LOG_MS
+    milliseconds together with their most repeated statements.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _stats() is not None:
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = _stats()
+        if stats is None or not conn.info.get('query_start'):
+            return
+        stats['db'] += time.perf_counter() - conn.info['query_start'].pop()
+        stats['count'] += 1
+        stats['statements'][statement] += 1
+
+    @before_render_template.connect_via(app)
+    def _before_render(sender, template, context, **extra):
+        stats = _stats()
+        if stats is not None:
+            stats['render_start'] = time.perf_counter()
+
+    @template_rendered.connect_via(app)
+    def _after_render(sender, template, context, **extra):
+        stats = _stats()
+        if stats is not None and stats.get('render_start'):
+            stats['render'] += time.perf_counter() - stats.pop('render_start')
+
+    @app.before_request
+    def _start_query_stats():
+        g.query_stats = {'start': time.perf_counter(), 'db': 0.0, 'count': 0, 'render': 0.0, 'statements': Counter()}
+
+    @app.after_request
+    def _report_query_stats(response):
+        stats = _stats()
+        if stats is None:
+            return response
+        total = (time.perf_counter() - stats['start']) * 1000
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                f"db;dur={stats['db'] * 1000:.1f}, db-count;desc={stats['count']}, "
+                f"render;dur={stats['render'] * 1000:.1f}, total;dur={total:.1f}")
+        if stats['count'] > app.config['QUERY_LOG_COUNT'] or total > app.config['QUERY_LOG_MS']:
+            repeated = [(n, sql) for sql, n in stats['statements'].most_common(3) if n > 1]
+            app.logger.warning(
+                "%s %s took %.0f ms with %d queries (%.0f ms in db)%s", request.method, request.full_path.rstrip('?'),
+                total, stats['count'], stats['db'] * 1000,
+                ''.join(f"\n  {n}x {_WHITESPACE.sub(' ', sql)[:200]}" for n, sql in repeated))
+        return response
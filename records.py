@@ -0,0 +1,232 @@
+from datetime import datetime, timezone
+from sqlalchemy import insert
+from models import db, Marathon, Station, Equipment, IssueRecord, ReturnRecord, StoreIssueRecord, StoreReturnRecord, IdempotencyKey
+from balances import apply_balance_deltas, row_deltas
+from names import normalize_name
+from events import log_inserted
+
+# Record type names accepted by the JSON APIs
+RECORD_TYPES = {
+    'issue': IssueRecord,
+    'return': ReturnRecord,
+    'store_issue': StoreIssueRecord,
+    'store_return': StoreReturnRecord,
+}
+RECORD_KINDS = {model: kind for kind, model in RECORD_TYPES.items()}
+
+
+def name_key(model):
+    """How names of `model` are compared: its normalized `lookup` key where it has one, else exactly"""
+    return normalize_name if hasattr(model, 'lookup') else (lambda n: n)
+
+
+def resolve_names(model, names):
+    """Map each name to the id of a `model` row, creating the missing rows.
+
+    Uses one SELECT for all names and a single flush for the new rows. Names are
+    compared with name_key(), so for marathons, persons, equipment and stations
+    names that differ only by case, accents or spacing share one row.
+    Returns {stripped name: id}.
+    """
+    names = {n.strip() for n in names if n and not n.isspace()}
+    if not names:
+        return {}
+    key = name_key(model)
+    column = model.lookup if hasattr(model, 'lookup') else model.name
+    ids = {key(name): id for id, name in
+           db.session.query(model.id, model.name).filter(column.in_({key(n) for n in names}))}
+    created = {}
+    for name in sorted(names):
+        if key(name) not in ids and key(name) not in created:
+            created[key(name)] = model(name=name)
+    if created:
+        db.session.add_all(created.values())
+        db.session.flush()
+        ids.update({k: obj.id for k, obj in created.items()})
+    return {name: ids[key(name)] for name in names}
+
+
+def canonical_name(model, name):
+    """Stored name of the `model` row that `name` resolves to (created if missing), or None when blank"""
+    ids = resolve_names(model, [name])
+    return db.session.get(model, ids[name.strip()]).name if ids else None
+
+
+def item_rows(equipment_ids, quantities):
+    """(equipment_id, quantity) pairs for form rows with an equipment and a positive quantity.
+
+    Returns (items, invalid) where `invalid` counts rows skipped for a non-numeric equipment id.
+    """
+    items = []
+    invalid = 0
+    for eq_id, qty in zip(equipment_ids, quantities):
+        try: q=int(qty)
+        except (TypeError, ValueError): q=0
+        if q<=0 or not eq_id: continue
+        try: eq=int(eq_id)
+        except (TypeError, ValueError):
+            invalid += 1
+            continue
+        items.append((eq, q))
+    return items, invalid
+
+
+def insert_records(model, items, created_by, **fields):
+    """Insert one `model` row per (equipment_id, quantity) with a single bulk INSERT.
+
+    `fields` (marathon_id, station_id, person_name) are shared by every row. The
+    StockBalance deltas are applied in the same transaction; the caller commits.
+    """
+    now = datetime.utcnow()
+    return insert_record_rows(model, [dict(fields, equipment_id=eq_id, quantity=q, timestamp=now, created_by=created_by) for eq_id, q in items])
+
+
+def note_inserted(model, count):
+    """Remember rows inserted in the current transaction; metrics.py counts them on commit"""
+    inserted = db.session.info.setdefault('inserted_records', {})
+    inserted[RECORD_KINDS[model]] = inserted.get(RECORD_KINDS[model], 0) + count
+
+
+def insert_record_rows(model, rows):
+    """Bulk INSERT prepared record dicts, apply their StockBalance deltas and log their events"""
+    if not rows:
+        return 0
+    ids = db.session.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), rows).all()
+    apply_balance_deltas(db.session.connection(), row_deltas(model, rows))
+    log_inserted(db.session, model, ids, rows)
+    note_inserted(model, len(rows))
+    return len(rows)
+
+
+def claim_keys(user_id, keys):
+    """Store a user's idempotency keys, returning the subset that was not already stored.
+
+    INSERT .. ON CONFLICT DO NOTHING RETURNING makes concurrent retries of the same
+    upload claim each key exactly once. Keys are scoped to the user, so two clients
+    that happen to pick the same key do not drop each other's records.
+    """
+    if not keys:
+        return set()
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    now = datetime.utcnow()
+    stmt = (dialect_insert(IdempotencyKey).on_conflict_do_nothing(index_elements=['user_id', 'key'])
+            .returning(IdempotencyKey.key))
+    return set(db.session.scalars(stmt, [{'user_id': user_id, 'key': k, 'created_at': now} for k in keys]))
+
+
+def prune_idempotency_keys(before):
+    """Delete idempotency keys claimed before `before`; returns the number deleted"""
+    count = IdempotencyKey.query.filter(IdempotencyKey.created_at < before).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def int_field(item, name, required=False):
+    """Integer value of item[name] (int or numeric string); ValueError if invalid"""
+    value = item.get(name)
+    if value in (None, ''):
+        if required:
+            raise ValueError(f'missing {name}')
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'invalid {name}')
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'invalid {name}')
+
+
+def parse_timestamp(value):
+    """ISO timestamp as naive UTC like datetime.utcnow(); the current time if empty"""
+    try:
+        timestamp = datetime.fromisoformat(value) if value else datetime.utcnow()
+    except (TypeError, ValueError):
+        raise ValueError('invalid timestamp')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _existing_ids(model, ids):
+    ids = {i for i in ids if i is not None}
+    if not ids:
+        return set()
+    return {i for (i,) in db.session.query(model.id).filter(model.id.in_(ids))}
+
+
+def ingest_batch(items, user):
+    """Validate and insert a batch of JSON records submitted by `user`.
+
+    Every record is checked first (ids are verified with one query per entity
+    type); if any is invalid nothing is written and the errors are returned.
+    Records whose `key` was already ingested are skipped as duplicates. The
+    caller commits.
+    Returns (result dict, errors list).
+    """
+    errors = []
+    parsed = []
+    seen_keys = set()
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('record must be an object')
+            model = RECORD_TYPES.get(item.get('type'))
+            if model is None:
+                raise ValueError('invalid type')
+            key = item.get('key')
+            if key is not None:
+                if not isinstance(key, str) or not key or len(key) > 100:
+                    raise ValueError('invalid key')
+                if key in seen_keys:
+                    raise ValueError('duplicate key in batch')
+                seen_keys.add(key)
+            quantity = int_field(item, 'quantity', required=True)
+            if quantity <= 0:
+                raise ValueError('quantity must be positive')
+            row = {
+                'marathon_id': int_field(item, 'marathon_id'),
+                'equipment_id': int_field(item, 'equipment_id', required=True),
+                'quantity': quantity,
+                'created_by': user.username,
+            }
+            if hasattr(model, 'station_id'):
+                row['station_id'] = int_field(item, 'station_id')
+                # Only admin can record on behalf of another person, like the forms
+                row['person_name'] = (item.get('person_name') if user.role == 'admin' else None) or user.username
+            else:
+                row['person_name'] = item.get('person_name')
+                if item.get('station_id') not in (None, ''):
+                    raise ValueError('station_id not allowed for store records')
+            if row['person_name'] is not None and not isinstance(row['person_name'], str):
+                raise ValueError('invalid person_name')
+            row['timestamp'] = parse_timestamp(item.get('timestamp'))
+            parsed.append((index, key, model, row))
+        except ValueError as e:
+            errors.append({'index': index, 'error': str(e)})
+
+    # Verify referenced ids with one query per entity type
+    known = {
+        'marathon_id': _existing_ids(Marathon, (row['marathon_id'] for _, _, _, row in parsed)),
+        'station_id': _existing_ids(Station, (row.get('station_id') for _, _, _, row in parsed)),
+        'equipment_id': _existing_ids(Equipment, (row['equipment_id'] for _, _, _, row in parsed)),
+    }
+    for index, _, _, row in parsed:
+        for field, ids in known.items():
+            if row.get(field) is not None and row[field] not in ids:
+                errors.append({'index': index, 'error': f'unknown {field}'})
+    if errors:
+        return None, sorted(errors, key=lambda e: e['index'])
+
+    claimed = claim_keys(user.id, [key for _, key, _, _ in parsed if key is not None])
+    rows_by_model = {}
+    duplicates = []
+    for _, key, model, row in parsed:
+        if key is not None and key not in claimed:
+            duplicates.append(key)
+            continue
+        rows_by_model.setdefault(model, []).append(row)
+    inserted = sum(insert_record_rows(model, rows) for model, rows in rows_by_model.items())
+    return {'inserted': inserted, 'duplicates': duplicates}, []
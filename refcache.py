@@ -0,0 +1,73 @@
+import threading
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, ReferenceVersion, DeletedReference, Marathon, Station, Equipment, Person
+
+# Cached list name -> (model, columns loaded); lists are ordered by name like the forms expect
+REFERENCE_LISTS = {
+    'marathons': (Marathon, ('id', 'name')),
+    'stations': (Station, ('id', 'name')),
+    'equipments': (Equipment, ('id', 'name', 'available_quantity')),
+    'persons': (Person, ('id', 'name')),
+}
+REFERENCE_MODELS = tuple(model for model, _ in REFERENCE_LISTS.values())
+REFERENCE_KINDS = {model: kind for kind, (model, _) in REFERENCE_LISTS.items()}
+
+_lock = threading.Lock()
+_cache = {'version': None, 'lists': {}}
+
+
+def reference_version():
+    """Current reference data generation, read at most once per request"""
+    if 'reference_version' not in g:
+        g.reference_version = db.session.query(ReferenceVersion.version).filter_by(id=1).scalar() or 0
+    return g.reference_version
+
+
+def reference_list(kind):
+    """Name-ordered rows for `kind`, shared by all requests of this worker process.
+
+    Rows are plain read-only tuples with attribute access (e.g. `s.id`, `s.name`).
+    The list is reloaded whenever the database generation counter has moved on.
+    """
+    version = reference_version()
+    with _lock:
+        if _cache['version'] != version:
+            _cache['version'] = version
+            _cache['lists'] = {}
+        rows = _cache['lists'].get(kind)
+    if rows is None:
+        model, columns = REFERENCE_LISTS[kind]
+        rows = tuple(db.session.query(*[getattr(model, c) for c in columns]).order_by(model.name).all())
+        with _lock:
+            if _cache['version'] == version:
+                _cache['lists'][kind] = rows
+    return list(rows)
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_reference_version(session, flush_context, instances):
+    """Bump the generation counter in the same transaction as any reference data change.
+
+    Changed rows are stamped with the new generation and deleted rows leave a
+    DeletedReference tombstone, so /api/sync can return what changed since a version.
+    """
+    changed = [obj for obj in session.new if isinstance(obj, REFERENCE_MODELS)]
+    changed += [obj for obj in session.dirty if isinstance(obj, REFERENCE_MODELS) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, REFERENCE_MODELS)]
+    if not changed and not deleted:
+        return
+    version = session.connection().execute(
+        ReferenceVersion.__table__.update().where(ReferenceVersion.id == 1)
+        .values(version=ReferenceVersion.version + 1).returning(ReferenceVersion.version)
+    ).scalar()
+    if version is None:
+        # Counter row not created yet (first boot); skip stamping rather than fail the write
+        return
+    for obj in changed:
+        obj.version = version
+    for obj in deleted:
+        session.add(DeletedReference(kind=REFERENCE_KINDS[type(obj)], ref_id=obj.id, version=version))
+    if has_app_context():
+        g.pop('reference_version', None)
@@ -0,0 +1,36 @@
+from models import db, Person, Equipment, Station
+from names import normalize_name
+
+SEARCH_MODELS = {'persons': Person, 'equipments': Equipment, 'stations': Station}
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+
+
+def search_names(kind, q, limit=SEARCH_LIMIT):
+    """Up to `limit` {id, name} rows of `kind` whose name starts with `q`.
+
+    Matching is on the normalized lookup key, so "nguyen" finds "Nguyễn". Names
+    starting with `q` come from a range scan of the unique lookup index; when those
+    do not fill the limit, names with a later word starting with `q` are added.
+    """
+    model = SEARCH_MODELS[kind]
+    key = normalize_name(q or '')
+    query = db.session.query(model.id, model.name).order_by(model.lookup)
+    if not key:
+        rows = query.limit(limit).all()
+    else:
+        # '\U0010ffff' sorts after every character, so this is "lookup LIKE key%" on the index
+        rows = query.filter(model.lookup >= key, model.lookup < key + '\U0010ffff').limit(limit).all()
+        if len(rows) < limit:
+            found = {r.id for r in rows}
+            words = query.filter(model.lookup.contains(' ' + key, autoescape=True)).limit(limit).all()
+            rows += [r for r in words if r.id not in found][:limit - len(rows)]
+    return [{'id': r.id, 'name': r.name} for r in rows]
+
+
+def name_taken(model, name, exclude_id=None):
+    """The existing `model` row whose normalized name equals `name`'s, other than `exclude_id`"""
+    query = model.query.filter(model.lookup == normalize_name(name))
+    if exclude_id is not None:
+        query = query.filter(model.id != exclude_id)
+    return query.first()
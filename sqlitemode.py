@@ -0,0 +1,51 @@
+import threading
+from functools import wraps
+from flask import current_app, request
+from sqlalchemy import event
+from models import db
+
+_write_lock = threading.Lock()
+
+
+def configure_sqlite(engine, busy_timeout_ms, production=False, mmap_size=0):
+    """Set pragmas on every new SQLite connection of `engine`.
+
+    busy_timeout makes a writer wait for the lock instead of failing with
+    "database is locked". Production mode switches to WAL, so readers never block
+    the writer, with synchronous=NORMAL (no fsync per commit, still crash-safe in
+    WAL) and memory-mapped reads.
+    """
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA busy_timeout = {int(busy_timeout_ms)}')
+        if production:
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute('PRAGMA synchronous = NORMAL')
+            if mmap_size:
+                cursor.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        cursor.close()
+
+
+def serialized_writes(f):
+    """Run POST requests of a route one at a time per process when SQLITE_WRITE_QUEUE is on.
+
+    SQLite has a single writer; queueing writers on a process lock is cheaper than
+    letting them collide on the database lock and retry. The request's transaction
+    starts inside the lock, so its snapshot is never older than another thread's
+    commit (WAL refuses to upgrade such a snapshot to a write).
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'GET' or not current_app.config['SQLITE_WRITE_QUEUE'] or db.engine.dialect.name != 'sqlite':
+            return f(*args, **kwargs)
+        with _write_lock:
+            if db.session().in_transaction():
+                db.session.rollback()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                # Release the database lock before the next queued writer starts
+                if db.session().in_transaction():
+                    db.session.rollback()
+    return decorated_function
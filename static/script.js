@@ -1,3 +1,65 @@
+// Live report pages: records pushed by /api/marathons/<id>/events are applied in place.
+// `onMessage` gets {records, deltas}; a bulk import or an expired cursor reloads the page.
+window.watchRecordEvents = function (marathonId, cursor, onMessage) {
+    if (!window.EventSource || cursor === null || cursor === undefined) return;
+    // EventSource gives up for good on a non-200 answer (e.g. 503 when the worker's
+    // stream slots are taken), so reconnect ourselves with backoff from the last event seen
+    let delay = 5000;
+    const connect = () => {
+        const source = new EventSource(`/api/marathons/${marathonId}/events?since=${cursor}`);
+        source.addEventListener('open', () => { delay = 5000; });
+        source.addEventListener('records', e => {
+            const data = JSON.parse(e.data);
+            if (data.reload) {
+                source.close();
+                location.reload();
+                return;
+            }
+            if (e.lastEventId) cursor = e.lastEventId;
+            onMessage(data);
+        });
+        source.addEventListener('error', () => {
+            if (source.readyState !== EventSource.CLOSED) return;  // the browser is already retrying
+            setTimeout(connect, delay * (0.5 + Math.random()));
+            delay = Math.min(delay * 2, 60000);
+        });
+    };
+    connect();
+};
+
+window.badge = function (cls, text) {
+    const span = document.createElement('span');
+    span.className = `badge ${cls}`;
+    span.textContent = text;
+    return span;
+};
+
+// Build a table row from cell values (text or elements), optionally with a class per cell
+window.tableRow = function (cells, cellClass) {
+    const row = document.createElement('tr');
+    cells.forEach(value => {
+        const td = document.createElement('td');
+        if (cellClass) td.className = cellClass;
+        td.append(value instanceof Node ? value : String(value));
+        row.appendChild(td);
+    });
+    return row;
+};
+
+// Replace, add (at the top) or remove the history row of a pushed record
+window.applyRecordRow = function (tbody, record, cells) {
+    const key = `${record.type}-${record.id}`;
+    const old = tbody.querySelector(`tr[data-record="${key}"]`);
+    if (record.deleted) {
+        if (old) old.remove();
+        return;
+    }
+    const row = tableRow(cells);
+    row.dataset.record = key;
+    if (old) old.replaceWith(row);
+    else tbody.prepend(row);
+};
+
 document.addEventListener('DOMContentLoaded', () => {
     function initTable(tableId, addBtnId) {
         const table = document.getElementById(tableId);
@@ -31,6 +93,40 @@ document.addEventListener('DOMContentLoaded', () => {
     
     initTable('equipment-table', 'add-row');
     
+    // The server returns the existing row when the name differs only by case or accents
+    function addOption(select, data) {
+        if ([...select.options].some(o => o.value == data.id)) return;
+        const opt = document.createElement('option');
+        opt.value = data.id;
+        opt.text = data.name;
+        select.appendChild(opt);
+    }
+
+    // Name suggestions for free-text inputs marked with data-search="persons|equipments|stations"
+    const searchTimers = {};
+    document.addEventListener('input', e => {
+        const input = e.target;
+        const kind = input.dataset && input.dataset.search;
+        if (!kind || !navigator.onLine) return;
+        let list = document.getElementById(`search-${kind}`);
+        if (!list) {
+            list = document.createElement('datalist');
+            list.id = `search-${kind}`;
+            document.body.appendChild(list);
+        }
+        input.setAttribute('list', list.id);
+        clearTimeout(searchTimers[kind]);
+        searchTimers[kind] = setTimeout(async () => {
+            const q = input.value.trim();
+            if (!q) return;
+            try {
+                const res = await fetch(`/api/search/${kind}?q=${encodeURIComponent(q)}&limit=10`);
+                if (!res.ok) return;
+                list.replaceChildren(...(await res.json()).map(r => new Option(r.name)));
+            } catch (err) { /* offline: no suggestions */ }
+        }, 200);
+    });
+
     const saveMarathon = document.getElementById('save-marathon');
     if (saveMarathon) saveMarathon.onclick = async () => {
         const name = document.getElementById('new-marathon-name').value.trim();
@@ -67,10 +163,7 @@ document.addEventListener('DOMContentLoaded', () => {
         });
         const data = await res.json();
         document.querySelectorAll('#station-select,#station-select-return').forEach(s => {
-            const opt = document.createElement('option');
-            opt.value = data.id;
-            opt.text = data.name;
-            s.appendChild(opt);
+            addOption(s, data);
             s.value = data.id; // Automatically select the new station
         });
         bootstrap.Modal.getInstance(document.getElementById('addStationModal')).hide();
@@ -87,12 +180,7 @@ document.addEventListener('DOMContentLoaded', () => {
             body: JSON.stringify({name})
         });
         const data = await res.json();
-        document.querySelectorAll('select[name="equipment[]"]').forEach(s => {
-            const opt = document.createElement('option');
-            opt.value = data.id;
-            opt.text = data.name;
-            s.appendChild(opt);
-        });
+        document.querySelectorAll('select[name="equipment[]"]').forEach(s => addOption(s, data));
         bootstrap.Modal.getInstance(document.getElementById('addEquipmentModal')).hide();
         document.getElementById('new-equipment-name').value = ''; // Clear the input field
     };
@@ -172,4 +260,160 @@ document.addEventListener('DOMContentLoaded', () => {
             return true; // Allow form submission to continue
         };
     }
+
+    // ---- Offline capture queue ----
+    // Issue/return entries made without connectivity are kept in localStorage and
+    // uploaded together with a reference-data delta request once back online.
+    const QUEUE_KEY = 'berao-queue';
+    const REJECTED_KEY = 'berao-rejected';
+    const REF_KEY = 'berao-ref';
+    const loadJSON = (key, fallback) => {
+        try { return JSON.parse(localStorage.getItem(key)) || fallback; } catch (e) { return fallback; }
+    };
+    const saveJSON = (key, value) => localStorage.setItem(key, JSON.stringify(value));
+    const newKey = () => (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+    function showQueueStatus() {
+        const count = loadJSON(QUEUE_KEY, []).length;
+        let badge = document.getElementById('offline-queue-status');
+        if (!count) { if (badge) badge.remove(); return; }
+        if (!badge) {
+            badge = document.createElement('div');
+            badge.id = 'offline-queue-status';
+            badge.className = 'alert alert-warning';
+            const main = document.querySelector('main');
+            if (main) main.prepend(badge);
+        }
+        badge.textContent = `${count} bản ghi đang chờ gửi khi có mạng.`;
+    }
+
+    // Add options for stations/equipment created elsewhere since this page was cached
+    function applyReferenceData(ref) {
+        const addMissing = (selector, items) => document.querySelectorAll(selector).forEach(sel => {
+            const present = new Set(Array.from(sel.options).map(o => o.value));
+            items.forEach(it => {
+                if (present.has(String(it.id))) return;
+                const opt = document.createElement('option');
+                opt.value = it.id;
+                opt.text = it.name;
+                sel.appendChild(opt);
+            });
+        });
+        addMissing('#station-select,#station-select-return', Object.values(ref.stations || {}));
+        addMissing('#issue-form select[name="equipment[]"]', Object.values(ref.equipments || {}));
+    }
+
+    function mergeDelta(delta) {
+        const ref = delta.full ? {version: 0} : loadJSON(REF_KEY, {version: 0});
+        ['stations', 'equipments', 'persons'].forEach(kind => {
+            const byId = ref[kind] || {};
+            (delta[kind] || []).forEach(it => { byId[it.id] = it; });
+            ((delta.deleted || {})[kind] || []).forEach(id => { delete byId[id]; });
+            ref[kind] = byId;
+        });
+        ref.marathons = delta.marathons;
+        ref.version = delta.version;
+        saveJSON(REF_KEY, ref);
+        return ref;
+    }
+
+    let syncing = false;
+    let batchMax = 1000;  // server's BATCH_MAX_RECORDS, updated from every /api/sync response
+    async function syncNow() {
+        if (syncing || !navigator.onLine) return;
+        syncing = true;
+        try {
+            // Upload the queue in chunks the server accepts; each response also carries the reference delta
+            while (true) {
+                const chunk = loadJSON(QUEUE_KEY, []).slice(0, batchMax);
+                const ref = loadJSON(REF_KEY, {version: 0});
+                const res = await fetch('/api/sync', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({since: ref.version || 0, records: chunk})
+                });
+                // Logged out: the API redirects to the login page
+                if (res.redirected || !(res.headers.get('Content-Type') || '').includes('application/json')) return;
+                const data = await res.json();
+                const max = data.max_records || data.max;
+                if (res.status === 413) {
+                    // The limit is lower than we assumed: retry with the server's
+                    if (!(max > 0 && max < chunk.length)) return;
+                    batchMax = max;
+                    continue;
+                }
+                if (max > 0) batchMax = max;
+                // Entries queued while this request was in flight stay queued after the chunk
+                const rest = loadJSON(QUEUE_KEY, []).slice(chunk.length);
+                if (res.status === 400 && data.errors && data.errors.length) {
+                    // Keep rejected entries aside so the rest of the queue can go through
+                    const bad = new Set(data.errors.map(e => e.index));
+                    saveJSON(REJECTED_KEY, loadJSON(REJECTED_KEY, []).concat(chunk.filter((_, i) => bad.has(i))));
+                    saveJSON(QUEUE_KEY, chunk.filter((_, i) => !bad.has(i)).concat(rest));
+                    continue;
+                }
+                if (!res.ok) return;
+                saveJSON(QUEUE_KEY, rest);
+                applyReferenceData(mergeDelta(data));
+                showQueueStatus();
+                if (!rest.length) return;
+            }
+        } catch (e) {
+            // Still offline; try again on the next 'online' event
+        } finally {
+            syncing = false;
+            showQueueStatus();
+        }
+    }
+
+    // Turn an issue/return form into /api/records/batch entries, or null if it needs the server
+    function formToRecords(form, type) {
+        const value = name => { const el = form.querySelector(`[name="${name}"]`); return el ? el.value.trim() : ''; };
+        if (value('new_marathon') || value('new_station')) return null;
+        const person = value('person') || value('new_person') || null;
+        const equipment = form.querySelectorAll('[name="equipment[]"]');
+        const newEquipment = form.querySelectorAll('[name="new_equipment[]"]');
+        const quantities = form.querySelectorAll('[name="quantity[]"]');
+        const records = [];
+        for (let i = 0; i < quantities.length; i++) {
+            if (newEquipment[i] && newEquipment[i].value.trim()) return null;
+            const qty = parseInt(quantities[i].value, 10);
+            if (!(qty > 0) || !equipment[i] || !equipment[i].value) continue;
+            records.push({
+                type,
+                key: newKey(),
+                marathon_id: value('marathon') || null,
+                station_id: value('station') || null,
+                equipment_id: equipment[i].value,
+                quantity: qty,
+                person_name: person,
+                timestamp: new Date().toISOString()
+            });
+        }
+        return records;
+    }
+
+    [['issue-form', 'issue'], ['return-form', 'return']].forEach(([formId, type]) => {
+        const form = document.getElementById(formId);
+        if (!form) return;
+        form.addEventListener('submit', e => {
+            if (navigator.onLine) return; // Normal server submit
+            e.preventDefault();
+            const records = formToRecords(form, type);
+            if (records === null) return alert('Cần có mạng để thêm tên mới. Vui lòng chọn từ danh sách.');
+            if (!records.length) return;
+            saveJSON(QUEUE_KEY, loadJSON(QUEUE_KEY, []).concat(records));
+            form.querySelectorAll('input[name="quantity[]"]').forEach(i => { i.value = type === 'issue' ? 1 : 0; });
+            showQueueStatus();
+            alert(`Đã lưu ${records.length} bản ghi trên máy, sẽ tự động gửi khi có mạng.`);
+        });
+    });
+
+    window.addEventListener('online', syncNow);
+    if (document.getElementById('issue-form') || document.getElementById('return-form')) {
+        if ('serviceWorker' in navigator) navigator.serviceWorker.register('/sw.js').catch(() => {});
+        applyReferenceData(loadJSON(REF_KEY, {}));
+        syncNow();
+    }
+    showQueueStatus();
 });
\ No newline at end of file
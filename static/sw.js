@@ -0,0 +1,48 @@
+// Service worker: keeps the issue/return pages and static assets usable offline.
+// Records entered offline are queued by script.js and uploaded through /api/sync.
+const CACHE = 'berao-v5';
+const PAGES = ['/issue', '/return'];
+const ASSETS = [
+    '/static/script.js',
+    '/static/style.css',
+    '/static/favicon.svg',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js'
+];
+
+self.addEventListener('install', event => {
+    event.waitUntil(caches.open(CACHE).then(cache => cache.addAll(ASSETS)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(k => k !== CACHE).map(k => caches.delete(k))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const req = event.request;
+    if (req.method !== 'GET') return;
+    const url = new URL(req.url);
+
+    // Static assets: cache first, they are versioned by deploys of this file
+    if (ASSETS.includes(url.origin === self.location.origin ? url.pathname : req.url)) {
+        event.respondWith(caches.match(req).then(hit => hit || fetch(req)));
+        return;
+    }
+
+    // Form pages: network first, fall back to the last copy seen online
+    if (url.origin === self.location.origin && PAGES.includes(url.pathname)) {
+        event.respondWith(
+            fetch(req).then(res => {
+                if (res.ok && !res.redirected) {
+                    const copy = res.clone();
+                    caches.open(CACHE).then(cache => cache.put(req, copy));
+                }
+                return res;
+            }).catch(() => caches.match(req).then(hit => hit || caches.match(req, {ignoreSearch: true})))
+        );
+    }
+});
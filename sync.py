@@ -0,0 +1,29 @@
+from models import db, DeletedReference
+from refcache import REFERENCE_LISTS, reference_version
+
+# Reference lists sent to offline clients as deltas; marathons are always sent in full
+# because their visibility depends on the user's assignments.
+DELTA_KINDS = ('stations', 'equipments', 'persons')
+
+
+def reference_delta(since, marathons):
+    """Reference data changed after generation `since` (0 means a full snapshot).
+
+    Returns {'version', 'marathons', 'stations', 'equipments', 'persons', 'deleted'}
+    where 'deleted' maps each kind to the ids removed since `since`.
+    """
+    version = reference_version()
+    delta = {'version': version, 'full': not since, 'marathons': [{'id': m.id, 'name': m.name} for m in marathons]}
+    for kind in DELTA_KINDS:
+        model, _ = REFERENCE_LISTS[kind]
+        query = db.session.query(model.id, model.name)
+        if since:
+            query = query.filter(model.version > since)
+        delta[kind] = [{'id': id, 'name': name} for id, name in query.order_by(model.name)]
+    delta['deleted'] = {kind: [] for kind in DELTA_KINDS}
+    if since:
+        tombstones = db.session.query(DeletedReference.kind, DeletedReference.ref_id).filter(
+            DeletedReference.version > since, DeletedReference.kind.in_(DELTA_KINDS))
+        for kind, ref_id in tombstones:
+            delta['deleted'][kind].append(ref_id)
+    return delta
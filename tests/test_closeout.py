@@ -0,0 +1,71 @@
+"""A closed marathon keeps its full history on the report pages and in the exports."""
+import csv
+import io
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# app.py binds its database at import time
+_database = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+os.environ['DATABASE_URL'] = f'sqlite:///{_database.name}'
+
+from app import app  # noqa: E402
+from closeout import close_marathon  # noqa: E402
+from migrations import migrate  # noqa: E402
+from models import db, Marathon, Station, Equipment, IssueRecord, ReturnRecord, StoreIssueRecord  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def closed_marathon():
+    with app.app_context():
+        db.drop_all()
+        migrate(report=lambda message: None)
+        marathon, station, equipment = Marathon(name='Giải A'), Station(name='Trạm 1'), Equipment(name='Rào chắn')
+        db.session.add_all([marathon, station, equipment])
+        db.session.flush()
+        now = datetime(2026, 3, 1, 6, 0)
+        db.session.add_all([
+            StoreIssueRecord(marathon_id=marathon.id, equipment_id=equipment.id, quantity=10, timestamp=now, created_by='admin'),
+            IssueRecord(marathon_id=marathon.id, station_id=station.id, equipment_id=equipment.id, quantity=10,
+                        person_name='An', timestamp=now, created_by='admin'),
+            ReturnRecord(marathon_id=marathon.id, station_id=station.id, equipment_id=equipment.id, quantity=7,
+                         person_name='An', timestamp=now, created_by='admin'),
+        ])
+        db.session.commit()
+        assert close_marathon(marathon.id, 'admin') == 3
+        db.session.commit()
+        assert IssueRecord.query.count() == ReturnRecord.query.count() == StoreIssueRecord.query.count() == 0
+        yield marathon.id
+    os.unlink(_database.name)
+
+
+def _client():
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return client
+
+
+def _csv_rows(response):
+    assert response.status_code == 200
+    return list(csv.reader(io.StringIO(response.get_data(as_text=True).lstrip('﻿'))))[1:]
+
+
+def test_exports_include_archived_records(closed_marathon):
+    client = _client()
+    report = _csv_rows(client.get(f'/report/export?marathon={closed_marathon}&format=csv'))
+    assert sorted((row[0], row[5]) for row in report) == [('Giao', '10'), ('Trả', '7')]
+    full = _csv_rows(client.get(f'/reconciliation_report/export?marathon={closed_marathon}&format=csv'))
+    assert sorted((row[0], row[5]) for row in full) == [('Giao', '10'), ('Trả', '7'), ('Xuất kho', '10')]
+
+
+def test_report_pages_show_archived_history(closed_marathon):
+    client = _client()
+    page = client.get(f'/report?marathon={closed_marathon}').get_data(as_text=True)
+    assert page.count('data-record="issue-') == 1 and page.count('data-record="return-') == 1
+    page = client.get(f'/reconciliation_report?marathon={closed_marathon}').get_data(as_text=True)
+    assert page.count('data-record="store_issue-') == 1